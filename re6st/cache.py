@@ -74,6 +74,9 @@ class Cache(object):
         for k, v in config:
             if k == 'crl':
                 v = set(json.loads(v))
+            elif k == 'registry_prefix':
+                if v is not None:
+                    v = utils.Prefix.fromStr(v)
             elif hasattr(cls, k):
                 continue
             setattr(self, k, v)
@@ -83,13 +86,36 @@ class Cache(object):
         logging.info("Getting new network parameters from registry...")
         try:
             # TODO: When possible, the registry should be queried via the re6st.
-            config = json.loads(zlib.decompress(
-                self._registry.getNetworkConfig(self._prefix)))
-            base64 = config.pop('', ())
-            config = dict((str(k), v.decode('base64') if k in base64 else
-                                   str(v) if type(v) is unicode else v)
-                          for k, v in config.iteritems())
-            config['crl'] = json.dumps(config['crl'])
+            if getattr(self, 'protocol', 0) < 3: # BBB
+                config = self._registry.getNetworkConfig(self._prefix)
+            else:
+                config = self._registry.getNetworkConfigDelta(self._prefix,
+                    getattr(self, 'version', ''),
+                    str(getattr(self, 'crl_version', 0)))
+            crl = None
+            if config == '':
+                logging.info("Network parameters are up-to-date")
+                config, base64, remove = {}, (), []
+            else:
+                config = json.loads(zlib.decompress(config))
+                base64 = config.pop('', ())
+                # Only changed parameters are sent if there's a list of
+                # removed ones.
+                remove = config.pop('-', None)
+                config = dict((str(k), v.decode('base64') if k in base64 else
+                                       str(v) if type(v) is unicode else v)
+                              for k, v in config.iteritems())
+                try:
+                    revoked, removed = config.pop('crl_delta')
+                except KeyError:
+                    if 'crl' in config:
+                        crl = set(config['crl'])
+                else:
+                    # Applying changes twice is harmless, so there's no need
+                    # to wait that the new config is saved.
+                    crl = self.crl
+                    crl.update(revoked)
+                    crl.difference_update(removed)
         except socket.error, e:
             logging.warning(e)
             return
@@ -99,29 +125,35 @@ class Cache(object):
             logging.exception("buggy registry ?")
             return
         # XXX: check version ?
+        if crl is not None:
+            config['crl'] = json.dumps(sorted(crl))
         self.delay_restart = config.pop("delay_restart", 0)
-        old = {}
         with self._db as db:
-            remove = []
-            for k, v in self._selectConfig(db.execute):
-                if k in config:
-                    old[k] = v
-                    continue
-                try:
-                    delattr(self, k)
-                except AttributeError:
-                    pass
-                remove.append(k)
-            db.execute("DELETE FROM config WHERE name in ('%s')"
-                       % "','".join(remove))
+            old = dict(self._selectConfig(db.execute))
+            if remove is None:
+                # The CRL is not sent if unchanged.
+                remove = [k for k in old if k not in config and k != 'crl']
+            else:
+                remove = [str(k) for k in remove if k in old]
+            changed = [k for k, v in config.iteritems()
+                         if k not in old or old[k] != v]
+            if remove:
+                for k in remove:
+                    try:
+                        delattr(self, k)
+                    except AttributeError:
+                        pass
+                db.execute("DELETE FROM config WHERE name in ('%s')"
+                           % "','".join(remove))
             # BBB: Use buffer because of http://bugs.python.org/issue13676
             #      on Python 2.6
             db.executemany("INSERT OR REPLACE INTO config VALUES(?,?)",
-                           ((k, buffer(v) if k in base64 else v)
-                            for k, v in config.iteritems()))
-        self._loadConfig(config.iteritems())
-        return [k for k, v in config.iteritems()
-                  if k not in old or old[k] != v]
+                           ((k, buffer(config[k]) if k in base64 else config[k])
+                            for k in changed))
+        self._loadConfig((k, config[k]) for k in changed if k != 'crl')
+        if crl is not None:
+            self.crl = crl
+        return changed
 
     def warnProtocol(self):
         if version.protocol < self.protocol:
@@ -193,7 +225,8 @@ class Cache(object):
                     " WHERE prefix=peer AND prefix!=? AND try=?"
     def getPeerList(self, failed=0, __sql=_get_peer_sql % "prefix, address"
                                                         + " ORDER BY RANDOM()"):
-        return self._db.execute(__sql, (self._prefix, failed))
+        for prefix, address in self._db.execute(__sql, (self._prefix, failed)):
+            yield utils.Prefix.fromStr(prefix), address
     def getPeerCount(self, failed=0, __sql=_get_peer_sql % "COUNT(*)"):
         return self._db.execute(__sql, (self._prefix, failed)).next()[0]
 
@@ -202,6 +235,7 @@ class Cache(object):
         try:
             bootpeer = self._registry.getBootstrapPeer(self._prefix)
             prefix, address = self._decrypt(bootpeer).split()
+            prefix = utils.Prefix.fromStr(prefix)
         except (socket.error, subprocess.CalledProcessError, ValueError), e:
             logging.warning('Failed to bootstrap (%s)',
                             e if bootpeer else 'no peer returned')
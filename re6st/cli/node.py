@@ -1,11 +1,10 @@
 #!/usr/bin/python2
 import atexit, errno, logging, os, shutil, signal
-import socket, struct, subprocess, sys, time, threading
+import socket, struct, sys
 from collections import deque
-from functools import partial
 if 're6st' not in sys.modules:
     sys.path[0] = os.path.dirname(os.path.dirname(sys.path[0]))
-from re6st import plib, tunnel, utils, version, x509
+from re6st import netlink, plib, tunnel, utils, version, x509
 from re6st.cache import Cache
 from re6st.utils import exit, ReexecException
 
@@ -70,6 +69,10 @@ def getConfig():
              " don't already have a default route), or if your kernel was"
              " compiled without support for source address based routing"
              " (CONFIG_IPV6_SUBTREES). Meaningless with --gateway.")
+    _('--babel-monitor', action='store_true',
+        help="Ask Babel to notify changes of routes and neighbours instead of"
+             " dumping them periodically. This requires a version of babeld"
+             " that supports it, and it is recommended on large networks.")
     _('--table', type=int, choices=(0,),
         help="DEPRECATED: Use --default instead of --table=0")
     _('--gateway', action='store_true',
@@ -143,6 +146,7 @@ def main():
 
     cache = Cache(db_path, config.registry, cert)
     network = cert.network
+    loop = utils.EventLoop()
 
     if config.client_count is None:
         config.client_count = cache.client_count
@@ -163,7 +167,6 @@ def main():
             config.disable_proto))
     address = ()
     server_tunnels = {}
-    forwarder = None
     if config.client:
         config.babel_args.append('re6stnet')
     elif config.max_clients:
@@ -208,7 +211,7 @@ def main():
             logging.info('Attempting automatic configuration via UPnP...')
             try:
                 from re6st.upnpigd import Forwarder
-                forwarder = Forwarder('re6stnet openvpn server')
+                forwarder = Forwarder('re6stnet openvpn server', loop)
             except Exception, e:
                 if config.ip:
                     raise
@@ -227,25 +230,13 @@ def main():
     else:
         ip_changed = remote_gateway = None
 
-    def call(cmd):
-        logging.debug('%r', cmd)
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                  stderr=subprocess.PIPE)
-        stdout, stderr = p.communicate()
-        if p.returncode:
-            raise EnvironmentError("%r failed with error %u\n%s"
-                                   % (' '.join(cmd), p.returncode, stderr))
-        return stdout
-    def ip4(object, *args):
-        args = ['ip', '-4', object, 'add'] + list(args)
-        call(args)
-        args[3] = 'del'
-        cleanup.append(lambda: subprocess.call(args))
-    def ip(object, *args):
-        args = ['ip', '-6', object, 'add'] + list(args)
-        call(args)
-        args[3] = 'del'
-        cleanup.append(lambda: subprocess.call(args))
+    rtnl = netlink.Netlink(blocking=True)
+    def ip(msg, *args, **kw):
+        logging.debug('%s%r', msg.__name__, args)
+        rtnl.check_call(msg(True, *args, **kw))
+        cleanup.append(lambda: rtnl.call(msg(False, *args, **kw)))
+    raw = lambda prefix: socket.inet_pton(socket.AF_INET6,
+                                          utils.ipFromBin(prefix))
 
     try:
         subnet = network + cert.prefix
@@ -265,36 +256,47 @@ def main():
         utils.makedirs(config.run, 0700)
         control_socket = os.path.join(config.run, 'babeld.sock')
         if config.client_count and not config.client:
-            tunnel_manager = tunnel.TunnelManager(control_socket,
+            tunnel_manager = tunnel.TunnelManager(loop, control_socket,
                 cache, cert, config.openvpn_args, timeout,
                 config.client_count, config.iface_list, address, ip_changed,
-                remote_gateway, config.disable_proto, config.neighbour)
-            config.babel_args += tunnel_manager.new_iface_list
+                remote_gateway, config.disable_proto, config.neighbour,
+                config.babel_monitor)
+            cleanup.append(tunnel_manager.delInterfaces)
+            config.babel_args += tunnel_manager.tap_list
         else:
-            tunnel_manager = tunnel.BaseTunnelManager(cache, cert, address)
+            tunnel_manager = tunnel.BaseTunnelManager(loop, config.run,
+                                                      cache, cert, address)
         cleanup.append(tunnel_manager.sock.close)
+        config.openvpn_args += '--crl-verify', tunnel_manager.crl_dir, 'dir'
 
         try:
             exit.acquire()
 
+            index = netlink.ifindex(config.main_interface)
             ipv4 = getattr(cache, 'ipv4', None)
             if ipv4:
                 serial = int(cert.cert.get_subject().serialNumber)
                 if cache.ipv4_sublen <= 16 and serial < 1 << cache.ipv4_sublen:
                     dot4 = lambda x: socket.inet_ntoa(struct.pack('!I', x))
-                    ip4('route', 'unreachable', ipv4, 'proto', 'static')
                     ipv4, n = ipv4.split('/')
+                    n = int(n)
+                    ip(netlink.route, socket.AF_INET, socket.inet_aton(ipv4),
+                       n, type=netlink.RTN_UNREACHABLE,
+                       protocol=netlink.RTPROT_STATIC)
                     ipv4, = struct.unpack('!I', socket.inet_aton(ipv4))
-                    n = int(n) + cache.ipv4_sublen
+                    n += cache.ipv4_sublen
                     x = ipv4 | serial << 32 - n
                     ipv4 = dot4(x | (n < 31))
                     config.openvpn_args += '--ifconfig', \
                         ipv4, dot4((1<<32) - (1<<32-n))
                     if not isinstance(tunnel_manager, tunnel.TunnelManager):
-                        ip4('addr', ipv4, 'dev', config.main_interface)
+                        ip(netlink.address, socket.AF_INET,
+                           socket.inet_aton(ipv4), 32, index)
                         if config.main_interface == "lo":
-                            ip4('route', 'unreachable', "%s/%s" % (dot4(x), n),
-                                'proto', 'static')
+                            ip(netlink.route, socket.AF_INET,
+                               struct.pack('!I', x), n,
+                               type=netlink.RTN_UNREACHABLE,
+                               protocol=netlink.RTPROT_STATIC)
                     ipv4 = ipv4, n
                 else:
                     logging.warning(
@@ -306,10 +308,9 @@ def main():
                     " does not support RTA_PREFSRC for ipv6. Note however that"
                     " this workaround does not work with extra interfaces that"
                     " already have a public IP")
-                ip('addrlabel', 'prefix', my_network, 'label', '99')
+                ip(netlink.addrlabel, raw(network), len(network), 99)
                 # No need to tell babeld not to set a preferred source IP in
                 # installed routes. The kernel will silently discard the option.
-            R = {}
             if config.client:
                 address_list = [x for x in utils.parse_address(config.client)
                                   if x[2] not in config.disable_proto]
@@ -325,51 +326,57 @@ def main():
                     dh = os.path.join(config.state, "dh.pem")
                     cache.getDh(dh)
                 for iface, (port, proto) in server_tunnels.iteritems():
-                    r, x = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+                    management = tunnel_manager.serverManagement(iface)
+                    cleanup.append(management.close)
                     cleanup.append(plib.server(iface, config.max_clients,
-                        dh, x.fileno(), port, proto, cache.encrypt,
-                        '--ping-exit', str(timeout), *config.openvpn_args,
-                        preexec_fn=r.close).stop)
-                    R[r] = partial(tunnel_manager.handleServerEvent, r)
-                    x.close()
+                        dh, management, port, proto, cache.encrypt,
+                        '--ping-exit', str(timeout),
+                        *config.openvpn_args).stop)
 
-            ip('addr', my_ip + '/%s' % len(subnet),
-               'dev', config.main_interface)
-            if_rt = ['ip', '-6', 'route', 'del',
-                     'fe80::/64', 'dev', config.main_interface]
+            ip(netlink.address, socket.AF_INET6, socket.inet_pton(
+                socket.AF_INET6, my_ip), len(subnet), index)
             if config.main_interface == 'lo':
                 # WKRD: Removed this useless route now, since the kernel does
                 #       not even remove it on exit.
-                subprocess.call(if_rt)
-            if_rt[4] = my_subnet
-            cleanup.append(lambda: subprocess.call(if_rt))
+                rtnl.call(netlink.route(False, socket.AF_INET6,
+                    socket.inet_pton(socket.AF_INET6, 'fe80::'), 64,
+                    oif=index))
+            cleanup.append(lambda: rtnl.call(netlink.route(False,
+                socket.AF_INET6, raw(subnet), len(subnet), oif=index)))
             if config.default:
-                def check_no_default_route():
-                    for route in call(('ip', '-6', 'route', 'show',
-                                        'default')).splitlines():
-                        if not (' proto babel ' in route
-                             or ' proto 42 ' in route):
-                            sys.exit("Detected default route (%s)"
-                                " whereas you specified --default."
-                                " Fix your configuration." % route)
-                check_no_default_route()
-                def check_no_default_route_thread():
+                def check_no_default_route(data):
+                    route = netlink.unpackRoute(data)
+                    if not (route.dst_len
+                            or route.table != netlink.RT_TABLE_MAIN
+                            or route.flags & netlink.RTM_F_CLONED
+                            or route.protocol == netlink.RTPROT_BABEL):
+                        gw = route.attrs.get(netlink.RTA_GATEWAY)
+                        sys.exit("Detected default route (%s)"
+                            " whereas you specified --default."
+                            " Fix your configuration." % (
+                            'via ' + socket.inet_ntop(socket.AF_INET6, gw)
+                            if gw else 'proto %u' % route.protocol))
+                def check_default_routes():
+                    for route in rtnl.dump(netlink.RTM_GETROUTE,
+                            netlink.packRoute(socket.AF_INET6, 0)):
+                        check_no_default_route(route)
+                def monitor_default_routes():
                     try:
-                        while True:
-                            time.sleep(60)
-                            try:
-                                check_no_default_route()
-                            except OSError, e:
-                                if e.errno != errno.ENOMEM:
-                                    raise
-                    except:
-                        utils.log_exception()
-                    finally:
-                        exit.kill_main(1)
-                t = threading.Thread(target=check_no_default_route_thread)
-                t.daemon = True
-                t.start()
-            ip('route', 'unreachable', my_network)
+                        msg_list = monitor.recv()
+                    except socket.error, e:
+                        if e.errno != errno.ENOBUFS:
+                            raise
+                        return check_default_routes()
+                    for type, flags, seq, data in msg_list:
+                        if type == netlink.RTM_NEWROUTE:
+                            check_no_default_route(data)
+                # Subscribe before dumping, not to miss any new route.
+                monitor = netlink.Netlink(netlink.RTMGRP_IPV6_ROUTE)
+                loop.addReader(monitor, monitor_default_routes)
+                cleanup.append(monitor.close)
+                check_default_routes()
+            ip(netlink.route, socket.AF_INET6, raw(network), len(network),
+               type=netlink.RTN_UNREACHABLE)
 
             config.babel_args += config.iface_list
             cleanup.append(plib.router((my_ip, len(subnet)), ipv4,
@@ -390,8 +397,7 @@ def main():
             for cmd in config.daemon or ():
                 cleanup.insert(-1, utils.Popen(cmd, shell=True).stop)
             try:
-                cleanup[-1:-1] = (tunnel_manager.delInterfaces,
-                                  tunnel_manager.killAll)
+                cleanup.insert(-1, tunnel_manager.killAll)
             except AttributeError:
                 pass
             if config.console:
@@ -403,19 +409,12 @@ def main():
                         frame.f_locals # main() locals
                     finally:
                         socket.close()
-                console = Console(config.console, console)
+                console = Console(config.console, console, loop)
                 cleanup.append(console.close)
 
             # main loop
             exit.release()
-            select_list = [forwarder.select] if forwarder else []
-            if config.console:
-                select_list.append(console.select)
-            select_list += tunnel_manager.select, utils.select
-            while True:
-                args = R.copy(), {}, []
-                for s in select_list:
-                    s(*args)
+            loop.run()
         finally:
             # XXX: We have a possible race condition if a signal is handled at
             #      the beginning of this clause, just before the following line.
@@ -1,6 +1,9 @@
 #!/usr/bin/python2
-import httplib, logging, os, socket, sys
+import errno, httplib, logging, os, socket, sys, threading, time
 from BaseHTTPServer import BaseHTTPRequestHandler
+from collections import deque
+from cStringIO import StringIO
+from Queue import Full, Queue
 from SocketServer import ThreadingTCPServer
 from urlparse import parse_qsl
 if 're6st' not in sys.modules:
@@ -42,6 +45,18 @@ class RequestHandler(BaseHTTPRequestHandler):
         pass
 
 
+class BufferedRequestHandler(RequestHandler):
+    # For AsyncHTTPServer: 'request' is the data that was already read,
+    # and the response is buffered in 'wfile'.
+
+    def setup(self):
+        self.rfile = StringIO(self.request)
+        self.wfile = StringIO()
+
+    def finish(self):
+        pass
+
+
 class HTTPServer4(ThreadingTCPServer):
 
     allow_reuse_address = True
@@ -57,6 +72,186 @@ class HTTPServer6(HTTPServer4):
         HTTPServer4.server_bind(self)
 
 
+class AsyncHTTPServer(object):
+    """HTTP server with an event loop and a fixed pool of threads
+
+    Connections are handled by the main event loop, which only reads
+    requests and sends replies, so that the number of threads does not
+    depend on the number of clients. Requests are processed by 'workers'
+    threads, because RPCs may sign, send mails or wait for other nodes.
+    When 'max_pending' requests are already waiting for a thread, new ones
+    are rejected with 503 (Service Unavailable). The threads and the queue
+    are shared by all listening sockets (see 'listen').
+
+    New connections are not accepted while there are already
+    'max_connections' open ones, or for a while after accept failed
+    (e.g. too many open files).
+    """
+
+    request_timeout = 60
+    accept_retry = 1
+
+    def __init__(self, loop, registry, workers, max_pending,
+                 max_connections):
+        self.loop = loop
+        self.registry = registry
+        self.max_connections = max_connections
+        self.connections = 0
+        self._listeners = []
+        self._accepting = True
+        self._retry = None
+        self._queue = Queue(max_pending)
+        # Replies of workers, for the main thread.
+        self._done = deque()
+        self._wakeup = os.pipe()
+        loop.addReader(self._wakeup[0], self._reply)
+        for _ in xrange(workers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+
+    def listen(self, address, family):
+        s = socket.socket(family, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if family == socket.AF_INET6:
+            s.setsockopt(SOL_IPV6, IPV6_V6ONLY, 1)
+        s.bind(address)
+        s.listen(128)
+        s.setblocking(0)
+        self._listeners.append(s)
+        if self._accepting:
+            self.loop.addReader(s, lambda: self._accept(s))
+        return s
+
+    def _accept(self, listener):
+        try:
+            s, client_address = listener.accept()
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.ECONNABORTED):
+                return
+            # EMFILE, ENFILE, ENOBUFS, ENOMEM...
+            logging.warning("accept: %s. Retrying in %ss.",
+                            os.strerror(e.errno), self.accept_retry)
+            self._pause()
+            self._retry = self.loop.at(time.time() + self.accept_retry,
+                                       self._resume)
+            return
+        HTTPConnection(self, s, client_address)
+        self.connections += 1
+        if self.connections >= self.max_connections:
+            self._pause()
+
+    def _pause(self):
+        if self._accepting:
+            self._accepting = False
+            for s in self._listeners:
+                self.loop.removeReader(s)
+
+    def _resume(self):
+        if not (self._accepting or self._retry and self._retry.pending or
+                self.connections >= self.max_connections):
+            self._accepting = True
+            for s in self._listeners:
+                self.loop.addReader(s, lambda s=s: self._accept(s))
+
+    def connectionClosed(self):
+        self.connections -= 1
+        self._resume()
+
+    def dispatch(self, connection, request):
+        try:
+            self._queue.put_nowait((connection, request))
+        except Full:
+            connection.send("HTTP/1.0 %u %s\r\nContent-Length: 0\r\n\r\n"
+                % (httplib.SERVICE_UNAVAILABLE,
+                   httplib.responses[httplib.SERVICE_UNAVAILABLE]))
+
+    def _work(self):
+        while True:
+            connection, request = self._queue.get()
+            try:
+                response = BufferedRequestHandler(request,
+                    connection.client_address, self.registry).wfile.getvalue()
+            except Exception:
+                logging.warning("%r", request, exc_info=1)
+                response = ''
+            self._done.append((connection, response))
+            os.write(self._wakeup[1], '\0')
+
+    def _reply(self):
+        os.read(self._wakeup[0], 4096)
+        done = self._done
+        while done:
+            connection, response = done.popleft()
+            connection.send(response)
+
+
+class HTTPConnection(object):
+
+    closed = False
+
+    def __init__(self, server, socket, client_address):
+        self.server = server
+        self.socket = socket
+        self.client_address = client_address
+        self._data = ''
+        socket.setblocking(0)
+        loop = server.loop
+        loop.addReader(socket, self._read)
+        self._timeout = loop.at(time.time() + server.request_timeout,
+                                self.close)
+
+    def close(self):
+        if self.closed:
+            return
+        loop = self.server.loop
+        self.closed = True
+        self._timeout.cancel()
+        loop.removeReader(self.socket)
+        loop.removeWriter(self.socket)
+        self.socket.close()
+        self.server.connectionClosed()
+
+    def _read(self):
+        try:
+            data = self.socket.recv(4096)
+        except socket.error:
+            data = None
+        if not data:
+            return self.close()
+        data = self._data + data
+        # A request without body is complete at the first empty line.
+        i = data.find('\n\r\n')
+        if i < 0:
+            i = data.find('\n\n')
+            if i < 0:
+                if len(data) > 65536:
+                    return self.close()
+                self._data = data
+                return
+        self._data = None
+        self.server.loop.removeReader(self.socket)
+        self.server.dispatch(self, data)
+
+    def send(self, data):
+        if self.closed: # timeout
+            return
+        if not data:
+            return self.close()
+        self._data = data
+        self.server.loop.addWriter(self.socket, self._write)
+
+    def _write(self):
+        try:
+            n = self.socket.send(self._data)
+        except socket.error:
+            return self.close()
+        self._data = self._data[n:]
+        if not self._data:
+            # HTTP/1.0: the response ends when the connection is closed.
+            self.close()
+
+
 def main():
     parser = utils.ArgParser(fromfile_prefix_chars='@',
         description="re6stnet registry used to bootstrap nodes"
@@ -102,6 +297,22 @@ def main():
                  " 3=DEBUG, 4=TRACE. Use SIGUSR1 to reopen log.")
     _('--min-protocol', default=version.min_protocol, type=int,
         help="Reject nodes that are too old. Current is %s." % version.protocol)
+    _('--max-sessions', type=int, default=100000,
+        help="Maximum number of authenticated sessions. The least recently"
+             " used ones are dropped, and clients must authenticate again.")
+    _('--session-timeout', type=int, default=86400,
+        help="Authenticated sessions that are not used during this number"
+             " of seconds are dropped.")
+    _('--workers', type=int, default=0,
+        help="Serve HTTP with an event loop and this number of threads to"
+             " process requests. If 0, there's 1 thread per connection.")
+    _('--max-pending', type=int, default=1000,
+        help="With --workers, maximum number of requests waiting for a"
+             " thread: others are rejected with 503.")
+    _('--max-connections', type=int, default=1000,
+        help="With --workers, maximum number of open connections: new ones"
+             " wait in the listen queue. Keep it below the limit of open"
+             " files.")
 
     _ = parser.add_argument_group('routing').add_argument
     _('--hello', type=int, default=15,
@@ -110,6 +321,10 @@ def main():
              " hello interval. It takes between 3 and 4 times the"
              " hello interval for Babel to re-establish connection with a"
              " node for which the direct connection has been cut.")
+    _('--babel-ttl', type=float, default=10,
+        help="Maximum age in seconds of the view of Babel routes that is"
+             " shared by requests like getBootstrapPeer. Older views are"
+             " still used, while being refreshed in background.")
 
     _ = parser.add_argument_group('tunnelling').add_argument
     _('--encrypt', action='store_true',
@@ -145,22 +360,30 @@ def main():
     if config.max_clients is None:
         config.max_clients = config.client_count * 2
 
-    server = registry.RegistryServer(config)
+    loop = utils.EventLoop()
+    server = registry.RegistryServer(config, loop)
     def requestHandler(request, client_address, _):
         RequestHandler(request, client_address, server)
 
-    server_dict = {}
-    if config.bind4:
-        r = HTTPServer4((config.bind4, config.port), requestHandler)
-        server_dict[r.fileno()] = r._handle_request_noblock
-    if config.bind6:
-        r = HTTPServer6((config.bind6, config.port), requestHandler)
-        server_dict[r.fileno()] = r._handle_request_noblock
-    if server_dict:
-        while True:
-            args = server_dict.copy(), {}, []
-            server.select(*args)
-            utils.select(*args)
+    server_list = []
+    if config.workers:
+        http = AsyncHTTPServer(loop, server, config.workers,
+                               config.max_pending, config.max_connections)
+        for family, bind in ((socket.AF_INET, config.bind4),
+                             (socket.AF_INET6, config.bind6)):
+            if bind:
+                server_list.append(http.listen((bind, config.port), family))
+    else:
+        if config.bind4:
+            server_list.append(HTTPServer4((config.bind4, config.port),
+                                           requestHandler))
+        if config.bind6:
+            server_list.append(HTTPServer6((config.bind6, config.port),
+                                           requestHandler))
+        for r in server_list:
+            loop.addReader(r, r._handle_request_noblock)
+    if server_list:
+        loop.run()
 
 
 if __name__ == "__main__":
@@ -3,36 +3,78 @@ from collections import namedtuple
 from . import utils
 
 uint16 = struct.Struct("!H")
+uint64x2 = struct.Struct("!QQ")
 header = struct.Struct("!HI")
 
+class Decoder(object):
+    """Generate the source of a decoding function
+
+    Packets are described by nested Struct/Array/String objects. Instead of
+    decoding each value with a call to these objects, a flat function is
+    compiled once for each description. Values are decoded inline, and
+    arrays of fixed-size items are decoded with a list comprehension.
+    """
+
+    def __init__(self):
+        self._env = {'new': tuple.__new__, 'uint16': uint16.unpack_from}
+        self._lines = []
+        self._n = 0
+        self.indent = '    '
+
+    def __call__(self, line):
+        self._lines.append(self.indent + line)
+
+    def const(self, value):
+        name = '_%u' % len(self._env)
+        self._env[name] = value
+        return name
+
+    def var(self):
+        self._n += 1
+        return 'x%u' % self._n
+
+    def compile(self, item):
+        self('return offset, ' + item._decode(self))
+        source = 'def decode(buffer, offset=0):\n' + '\n'.join(self._lines)
+        exec source in self._env
+        return self._env['decode']
+
 class Struct(object):
 
+    size = None
+
     def __init__(self, format, *args):
-        if args:
-            t = namedtuple(*args)
+        self._format = format
         if isinstance(format, str):
-            s = struct.Struct("!" + format)
+            s = self._struct = struct.Struct("!" + format)
+            self.size = s.size
             def encode(buffer, value):
                 buffer += s.pack(*value)
-            def decode(buffer, offset=0):
-                return offset + s.size, t(*s.unpack_from(buffer, offset))
         else:
             def encode(buffer, value):
                 for f, value in zip(format, value):
                     f.encode(buffer, value)
-            def decode(buffer, offset=0):
-                r = []
-                for f in format:
-                    offset, x = f.decode(buffer, offset)
-                    r.append(x)
-                return offset, t(*r)
         self.encode = encode
-        self.decode = decode
+        if args:
+            self._type = namedtuple(*args)
+            self.decode = Decoder().compile(self)
+
+    def _decode(self, d):
+        x = d.var()
+        if self.size is None:
+            d('%s = new(%s, (%s,))' % (x, d.const(self._type),
+                ', '.join(f._decode(d) for f in self._format)))
+        else:
+            d('%s = new(%s, %s(buffer, offset))' % (x, d.const(self._type),
+                d.const(self._struct.unpack_from)))
+            d('offset += %u' % self.size)
+        return x
 
 class Array(object):
 
     def __init__(self, item):
         self._item = item
+        self.decode = Decoder().compile(self)
 
     def encode(self, buffer, value):
         buffer += uint16.pack(len(value))
@@ -40,17 +82,34 @@ class Array(object):
         for value in value:
             encode(buffer, value)
 
-    def decode(self, buffer, offset=0):
-        r = []
-        o = offset + 2
-        decode = self._item.decode
-        for i in xrange(*uint16.unpack_from(buffer, offset)):
-            o, x = decode(buffer, o)
-            r.append(x)
-        return o, r
+    def _decode(self, d):
+        item = self._item
+        x = d.var()
+        n = d.var()
+        d('%s, = uint16(buffer, offset)' % n)
+        d('offset += 2')
+        if item.size is None:
+            d('%s = []' % x)
+            d('for _ in xrange(%s):' % n)
+            indent = d.indent
+            d.indent += '    '
+            d('%s.append(%s)' % (x, item._decode(d)))
+            d.indent = indent
+        else:
+            # Fixed-size items: no need to increment 'offset' for each.
+            # Note that unpacking with a single repeated format is slower.
+            i = d.var()
+            d('%s = offset + %s * %u' % (n, n, item.size))
+            d('%s = [new(%s, %s(buffer, %s)) for %s in xrange(offset, %s, %u)]'
+              % (x, d.const(item._type), d.const(item._struct.unpack_from),
+                 i, i, n, item.size))
+            d('offset = %s' % n)
+        return x
 
 class String(object):
 
+    size = None
+
     @staticmethod
     def encode(buffer, value):
         buffer += value + "\0"
@@ -60,35 +119,94 @@ class String(object):
         i = buffer.index("\0", offset)
         return i + 1, buffer[offset:i]
 
+    @staticmethod
+    def _decode(d):
+        x = d.var()
+        i = d.var()
+        d('%s = buffer.index("\\0", offset)' % i)
+        d('%s = buffer[offset:%s]' % (x, i))
+        d('offset = %s + 1' % i)
+        return x
+
 
 class Buffer(object):
+    """Buffer of pending data, between offsets _r and _e
+
+    Data is received with recv_into directly in free space, and sent from a
+    memoryview, so that nothing is copied except when the buffer is
+    compacted, i.e. when pending data is moved at the beginning to make
+    room for more. It grows as needed, and it is released as soon as it's
+    empty if it got bigger than 'size'.
+    """
+
+    size = 1 << 16
 
     def __init__(self):
         self._buf = bytearray()
-        self._r = self._w = 0
+        self._r = self._e = self._w = 0
 
+    def _reserve(self, n):
+        """Make sure that n bytes can be added after pending data"""
+        buf = self._buf
+        r = self._r
+        e = self._e
+        if len(buf) < e + n:
+            n += e - r
+            if len(buf) < n:
+                size = max(len(buf), self.size)
+                while size < n:
+                    size <<= 1
+                new = bytearray(size)
+                new[:e-r] = memoryview(buf)[r:e]
+                self._buf = new
+            elif r:
+                buf[:e-r] = buf[r:e]
+            self._r = 0
+            self._e = e - r
+            self._w -= r
 
     def __iadd__(self, value):
-        self._buf += value
+        buf = self._buf
+        e = self._e
+        if e == len(buf):
+            buf += value
+            self._e = len(buf)
+        else:
+            n = e + len(value)
+            if len(buf) < n:
+                self._reserve(len(value))
+                e = self._e
+                n = e + len(value)
+            self._buf[e:n] = value
+            self._e = n
         return self
 
     def __len__(self):
-        return len(self._buf)
+        return self._e - self._r
 
     def _seek(self, r):
-        n = len(self._buf)
-        if r < n:
+        e = self._e
+        if r < e:
             self._r = r
         else:
-            self._w -= n
-            del self._buf[:]
-            self._r = 0
+            self._w -= e
+            self._r = self._e = 0
+            if len(self._buf) > self.size:
+                self._buf = bytearray()
 
     # reading
 
+    def recv_into(self, socket):
+        """Receive as much as possible, return the number of bytes read"""
+        self._reserve(max(self._w - self._e, self.size >> 2))
+        e = self._e
+        n = socket.recv_into(memoryview(self._buf)[e:])
+        self._e = e + n
+        return n
+
     @property
     def ready(self):
-        return self._w <= len(self._buf)
+        return self._w <= self._e
 
     def want(self, n):
         self._w = self._r + n
@@ -109,13 +227,12 @@ class Buffer(object):
     except TypeError:
         def unpack_from(self, struct):
             r = self._r
-            x = r + struct.size
-            value = struct.unpack(buffer(self._buf)[r:x])
-            self._seek(x)
+            value = struct.unpack_from(buffer(self._buf), r)
+            self._seek(r + struct.size)
             return value
         def decode(self, decode):
             r = self._r
-            size, value = decode(buffer(self._buf)[r:])
+            size, value = decode(str(self._buf[r:self._w]))
             self._seek(r + size)
             return value
 
@@ -123,10 +240,10 @@ class Buffer(object):
 
     def send(self, socket, *args):
         r = self._r
-        self._seek(r + socket.send(self._buf[r:], *args))
+        self._seek(r + socket.send(memoryview(self._buf)[r:self._e], *args))
 
     def pack_into(self, struct, offset, *args):
-        struct.pack_into(self._buf, offset, *args)
+        struct.pack_into(self._buf, self._r + offset, *args)
 
 
 class Packet(object):
@@ -159,19 +276,45 @@ class Packet(object):
                          len(buffer) - header.size - offset)
 
 
+interface = Struct((Struct("I", "index", "index"), String), "interface", "index name")
+neighbour = Struct("16sIHHHHHiHH", "neighbour", "address ifindex reach rxcost txcost rtt rttcost channel if_up cost_multiplier")
+xroute = Struct("16sBH", "xroute", "prefix plen metric")
+route = Struct("16sBHHH8siiI16s16sB", "route", "prefix plen metric smoothed_metric refmetric id seqno age ifindex neigh_address nexthop flags")
+
+# Sections of dumps. Routes are indexed by neighbour, so a dump of routes
+# is always requested with neighbours.
+INTERFACES = 1
+NEIGHBOURS = 2
+XROUTES = 4
+ROUTES = 8 # installed only
+FULL = INTERFACES | NEIGHBOURS | ROUTES
+
 Dump = Packet(1,
   Struct("B"),
-  Struct((
-    Array(Struct((Struct("I", "index", "index"), String), "interface", "index name")),
-    Array(Struct("16sIHHHHHiHH", "neighbour", "address ifindex reach rxcost txcost rtt rttcost channel if_up cost_multiplier")),
-    Array(Struct("16sBH", "xroute", "prefix plen metric")),
-    Array(Struct("16sBHHH8siiI16s16sB", "route", "prefix plen metric smoothed_metric refmetric id seqno age ifindex neigh_address nexthop flags")),
-    ), "dump", "interfaces neighbours xroutes routes"))
+  Struct(map(Array, (interface, neighbour, xroute, route)),
+    "dump", "interfaces neighbours xroutes routes"))
 
 SetCostMultiplier = Packet(2,
   Struct("16sIH"),
   Struct("B", "set_cost_multiplier", "flags"))
 
+# Same flags as Dump, to which babeld replies with the same full dump.
+# Then, it pushes changes of the requested sections as the following
+# packets, until the connection is closed. A 'monitor' packet may be sent
+# again at any time to resynchronize, e.g. after some events were dropped.
+Monitor = Packet(3,
+  Struct("B"),
+  Struct(map(Array, (interface, neighbour, xroute, route)),
+    "monitor", "interfaces neighbours xroutes routes"))
+# Added or changed (any field, including the cost multiplier).
+Packet(4, None, Struct((neighbour,), "neighbour_update", "neighbour"))
+Packet(5, None, Struct((neighbour,), "neighbour_flush", "neighbour"))
+# Installed routes only.
+Packet(6, None, Struct((route,), "route_update", "route"))
+Packet(7, None, Struct((route,), "route_flush", "route"))
+Packet(8, None, Struct((interface,), "interface_update", "interface"))
+Packet(9, None, Struct((interface,), "interface_flush", "interface"))
+
 
 class BabelException(Exception): pass
 
@@ -183,61 +326,96 @@ class ConnectionClosed(BabelException):
 
 
 class Babel(object):
+    """Client of the control socket of babeld
+
+    'neighbours', 'locked' and 'interfaces' are views of the state of babeld,
+    and 'handler.babel_dump' is called whenever they are refreshed with a
+    dump: 'fresh' tells which sections it contained. With 'monitor', babeld
+    is asked to push changes, which are applied incrementally to these
+    views, and 'request_dump' only needs to contact babeld at connection:
+    'handler.babel_changed' is then called after each batch of changes.
+    """
 
-    _decode = None
+    _changed = _decode = _monitoring = False
+    _dumping = _pending = 0
+    fresh = FULL
 
-    def __init__(self, socket_path, handler, network):
+    socket = None
+
+    def __init__(self, socket_path, handler, network, loop, monitor=False):
         self.socket_path = socket_path
         self.handler = handler
         self.network = network
+        self.loop = loop
+        self.monitor = monitor
         self.locked = set()
+        self._load(FULL, (), (), ())
         self.reset()
 
     def reset(self):
-        try:
-            del self.socket, self.request_dump
-        except AttributeError:
-            pass
+        s = self.socket
+        if s:
+            self.loop.removeReader(s)
+            self.loop.removeWriter(s)
+            s.close()
+            del self.socket
+        self._monitoring = False
+        self._dumping = self._pending = 0
         self.write_buffer = Buffer()
         self.read_buffer = Buffer()
         self.read_buffer.want(header.size)
+
+    def _connect(self):
         s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        def select(*args):
-            try:
-                s.connect(self.socket_path)
-            except socket.error, e:
-                logging.debug("%s", e)
-                return e
-            s.send("\1")
-            s.setblocking(0)
-            del self.select
-            self.socket = s
-            return self.select(*args)
-        self.select = select
-
-    def request_dump(self):
-        if self.select({}, {}, ()):
-            self.handle_dump((), (), (), ())
+        try:
+            s.connect(self.socket_path)
+        except socket.error, e:
+            logging.debug("%s", e)
+            s.close()
+            return e
+        s.send("\1")
+        s.setblocking(0)
+        self.socket = s
+        self.loop.addReader(s, self._read)
+        if self.write_buffer:
+            self.loop.addWriter(s, self._write)
+
+    def request_dump(self, sections=FULL):
+        """Refresh the given sections of the views
+
+        A request that is covered by the dump in progress is merged with it.
+        Otherwise, it is queued and merged with other such requests.
+        """
+        if sections & ROUTES:
+            sections |= NEIGHBOURS
+        if not self.socket:
+            if self._connect():
+                self._dumping = sections
+                return self.handle_dump((), (), (), ())
+            if self.monitor:
+                self.send(Monitor(FULL))
+                return
+        if self.monitor:
+            # Until babeld replies, babel_dump will be called anyway.
+            if self._monitoring:
+                self.handler.babel_dump()
+        elif self._dumping:
+            if sections & ~self._dumping:
+                self._pending |= sections
         else:
-            # interfaces + neighbours + installed routes
-            self.request_dump = lambda: self.send(Dump(11))
-            self.request_dump()
+            self._dumping = sections
+            self.send(Dump(sections))
 
     def send(self, packet):
-        packet.write(self.write_buffer)
-
-    def select(self, r, w, t):
-        s = self.socket
-        r[s] = self._read
-        if self.write_buffer:
-            w[s] = self._write
+        b = self.write_buffer
+        if not b and self.socket:
+            self.loop.addWriter(self.socket, self._write)
+        packet.write(b)
 
     def _read(self):
-        d = self.socket.recv(65536)
-        if not d:
-            raise ConnectionClosed(self.socket_path)
         b = self.read_buffer
-        b += d
+        if not b.recv_into(self.socket):
+            raise ConnectionClosed(self.socket_path)
         while b.ready:
             if self._decode:
                 packet = b.decode(self._decode)
@@ -254,46 +432,215 @@ class Babel(object):
                 packet_type, size = b.unpack_from(header)
                 self._decode = Packet.response_dict[packet_type]
                 b.want(size)
+        if self._changed:
+            self._changed = False
+            self.handler.babel_changed()
 
     def _write(self):
-        self.write_buffer.send(self.socket)
+        b = self.write_buffer
+        b.send(self.socket)
+        if not b:
+            self.loop.removeWriter(self.socket)
 
     def handle_dump(self, interfaces, neighbours, xroutes, routes):
+        sections = self._dumping
+        self._dumping = pending = self._pending
+        if pending:
+            self._pending = 0
+            self.send(Dump(pending))
+        self._load(sections, interfaces, neighbours, routes)
+        self.fresh = sections
+        self._changed = False
+        self.handler.babel_dump()
+
+    def handle_monitor(self, interfaces, neighbours, xroutes, routes):
+        self._load(FULL, interfaces, neighbours, routes)
+        if self._monitoring: # resynchronization
+            self._changed = True
+        else:
+            self._monitoring = True
+            self._changed = False
+            self.handler.babel_dump()
+
+    def _load(self, sections, interfaces, neighbours, routes):
+        if sections & INTERFACES:
+            self.interfaces = dict((i.index, name) for i, name in interfaces)
+        if not sections & ROUTES:
+            if sections & NEIGHBOURS:
+                # Few neighbours: the event handlers are fast enough.
+                flushed = set(self._neighbours)
+                for neigh in neighbours:
+                    flushed.discard((neigh.address, neigh.ifindex))
+                    self.handle_neighbour_update(neigh)
+                for address in flushed:
+                    self.handle_neighbour_flush(self._neighbours[address][0])
+            return
         # neighbours = {neigh_prefix: (neighbour, {dst_prefix: route})}
-        n = dict(((n.address, n.ifindex), (n, {})) for n in neighbours)
-        unidentified = set(n)
-        self.neighbours = neighbours = {}
-        a = len(self.network)
+        self.neighbours = neighbours_ = {}
+        # same as 'neighbours' but indexed by (address, ifindex)
+        self._neighbours = n = dict(((x.address, x.ifindex), (x, {}))
+                                    for x in neighbours)
+        # {(address, ifindex): neigh_prefix}
+        self._identified = identified = {}
+        # {(prefix, plen): ((address, ifindex), dst_prefix, route)}
+        self._installed = installed = {}
+        # This is the hottest loop on big networks, hence the code that is
+        # inlined from handle_route_update & _dstPrefix.
+        net, a = self.network
+        shift = 128 - a
+        unpack = uint64x2.unpack
+        Prefix = utils.Prefix
+        empty = Prefix((0, 0))
         for route in routes:
-            assert route.flags & 1, route # installed
-            if route.prefix.startswith('\0\0\0\0\0\0\0\0\0\0\xff\xff'):
+            (dst, plen, _, _, refmetric, _, _, _,
+             ifindex, neigh_address, nexthop, flags) = route
+            assert flags & 1, route # installed
+            if dst.startswith('\0\0\0\0\0\0\0\0\0\0\xff\xff'):
                 continue
-            assert route.neigh_address == route.nexthop, route
-            address = route.neigh_address, route.ifindex
+            assert neigh_address == nexthop, route
+            address = neigh_address, ifindex
             neigh_routes = n[address]
-            ip = utils.binFromRawIp(route.prefix)
-            if ip[:a] == self.network:
-                prefix = ip[a:route.plen]
-                if prefix and not route.refmetric:
-                    neighbours[prefix] = neigh_routes
-                    unidentified.remove(address)
+            hi, lo = unpack(dst)
+            ip = hi << 64 | lo
+            if ip >> shift == net:
+                j = plen - a
+                if j > 0:
+                    prefix = Prefix((ip >> 128 - plen & (1 << j) - 1, j))
+                    if not refmetric:
+                        neighbours_[prefix] = neigh_routes
+                        identified[address] = prefix
+                else:
+                    prefix = empty
             else:
                 prefix = None
             neigh_routes[1][prefix] = route
-        self.locked.clear()
+            installed[dst, plen] = address, prefix, route
+        # routes via unidentified neighbours
+        self._unidentified = unidentified = {}
+        locked = self.locked
+        locked.clear()
+        for address, (neigh, routes) in n.iteritems():
+            if address not in identified:
+                if not neigh.cost_multiplier:
+                    locked.add(address)
+                unidentified.update(routes)
+        self._updateUnidentified()
         if unidentified:
+            logging.trace("Routes via unidentified neighbours. %r",
+                          self.neighbours)
+
+    def _dstPrefix(self, dst, plen):
+        """Return the prefix inside our network of a route, or None
+
+        dst is the raw destination, as given by babeld.
+        """
+        net, a = self.network
+        hi, lo = uint64x2.unpack(dst)
+        ip = hi << 64 | lo
+        if ip >> 128 - a == net:
+            j = plen - a
+            if j > 0:
+                return utils.Prefix((ip >> 128 - plen & (1 << j) - 1, j))
+            return utils.Prefix((0, 0))
+
+    def _identify(self, address, prefix):
+        self._identified[address] = prefix
+        self.neighbours[prefix] = neigh_routes = self._neighbours[address]
+        self.locked.discard(address)
+        unidentified = self._unidentified
+        for x, route in neigh_routes[1].iteritems():
+            if unidentified.get(x) is route:
+                del unidentified[x]
+
+    def _unidentify(self, address):
+        del self.neighbours[self._identified.pop(address)]
+        neigh, routes = self._neighbours[address]
+        self._unidentified.update(routes)
+        if not neigh.cost_multiplier:
+            self.locked.add(address)
+
+    def _updateUnidentified(self):
+        if self._unidentified:
+            self.neighbours[None] = None, self._unidentified
+        else:
+            self.neighbours.pop(None, None)
+
+    def _removeRoute(self, route):
+        try:
+            address, prefix, route = self._installed.pop(
+                (route.prefix, route.plen))
+        except KeyError:
+            return
+        routes = self._neighbours[address][1]
+        if routes.get(prefix) is route:
+            del routes[prefix]
+        if address in self._identified:
+            if self._identified[address] == prefix and not route.refmetric:
+                self._unidentify(address)
+        elif self._unidentified.get(prefix) is route:
+            del self._unidentified[prefix]
+
+    def handle_neighbour_update(self, neigh):
+        address = neigh.address, neigh.ifindex
+        try:
+            routes = self._neighbours[address][1]
+        except KeyError:
             routes = {}
-            for address in unidentified:
-                neigh, r = n[address]
-                if not neigh.cost_multiplier:
-                    self.locked.add(address)
-                routes.update(r)
-            if routes:
-                neighbours[None] = None, routes
-                logging.trace("Routes via unidentified neighbours. %r",
-                              neighbours)
-        self.interfaces = dict((i.index, name) for i, name in interfaces)
-        self.handler.babel_dump()
+        self._neighbours[address] = neigh_routes = neigh, routes
+        try:
+            self.neighbours[self._identified[address]] = neigh_routes
+        except KeyError:
+            if neigh.cost_multiplier:
+                self.locked.discard(address)
+            else:
+                self.locked.add(address)
+        self._changed = True
+
+    def handle_neighbour_flush(self, neigh):
+        address = neigh.address, neigh.ifindex
+        if address in self._neighbours:
+            # babeld should have flushed the routes first.
+            for route in [route for x, _, route in self._installed.itervalues()
+                                if x == address]:
+                self._removeRoute(route)
+            if address in self._identified:
+                self._unidentify(address)
+            del self._neighbours[address]
+            self.locked.discard(address)
+            self._updateUnidentified()
+            self._changed = True
+
+    def handle_route_update(self, route):
+        assert route.flags & 1, route # installed
+        if route.prefix.startswith('\0\0\0\0\0\0\0\0\0\0\xff\xff'):
+            return
+        assert route.neigh_address == route.nexthop, route
+        self._removeRoute(route)
+        address = route.neigh_address, route.ifindex
+        neigh_routes = self._neighbours[address]
+        prefix = self._dstPrefix(route.prefix, route.plen)
+        if prefix and not route.refmetric:
+            self._identify(address, prefix)
+        neigh_routes[1][prefix] = route
+        self._installed[route.prefix, route.plen] = address, prefix, route
+        if address not in self._identified:
+            self._unidentified[prefix] = route
+        self._updateUnidentified()
+        self._changed = True
+
+    def handle_route_flush(self, route):
+        self._removeRoute(route)
+        self._updateUnidentified()
+        self._changed = True
+
+    def handle_interface_update(self, interface):
+        index, name = interface
+        self.interfaces[index.index] = name
+        self._changed = True
+
+    def handle_interface_flush(self, interface):
+        self.interfaces.pop(interface[0].index, None)
+        self._changed = True
 
     def handle_set_cost_multiplier(self, flags):
         pass
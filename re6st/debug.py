@@ -46,7 +46,7 @@ class Socket(object):
 
 class Console(object):
 
-    def __init__(self, path, pdb):
+    def __init__(self, path, pdb, loop):
         self.path = path
         s = socket.socket(socket.AF_UNIX)
         try:
@@ -60,9 +60,7 @@ class Console(object):
             t = threading.Thread(target=pdb, args=(Socket(s.accept()[0]),))
             t.daemon = True
             t.start()
-        def select(r, w, t):
-            r[s] = accept
-        self.select = select
+        loop.addReader(s, accept)
 
     def close(self):
         if stat.S_ISSOCK(os.lstat(self.path).st_mode):
@@ -0,0 +1,248 @@
+"""Minimal rtnetlink(7) client"""
+import errno, fcntl, os, socket, struct
+from collections import namedtuple
+
+NETLINK_ROUTE = 0
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+NLM_F_REQUEST = 1
+NLM_F_MULTI = 2
+NLM_F_ACK = 4
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+NLM_F_DUMP = 0x300
+
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_GETROUTE = 26
+RTM_NEWADDRLABEL = 72
+RTM_DELADDRLABEL = 73
+
+RTMGRP_IPV6_ROUTE = 0x400
+
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_TABLE = 15
+
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+
+IFAL_ADDRESS = 1
+IFAL_LABEL = 2
+
+RTN_UNICAST = 1
+RTN_LOCAL = 2
+RTN_UNREACHABLE = 7
+
+RTPROT_BOOT = 3
+RTPROT_STATIC = 4
+RTPROT_BABEL = 42
+
+RT_SCOPE_UNIVERSE = 0
+RT_SCOPE_LINK = 253
+RT_SCOPE_NOWHERE = 255
+
+RT_TABLE_MAIN = 254
+
+RTM_F_CLONED = 0x200
+
+SIOCGIFINDEX = 0x8933
+
+nlmsghdr = struct.Struct("=IHHII")
+nlmsgerr = struct.Struct("=i")
+rtmsg = struct.Struct("=BBBBBBBBI")
+rtattr = struct.Struct("=HH")
+ifaddrmsg = struct.Struct("=BBBBI")
+ifaddrlblmsg = struct.Struct("=BBBBII")
+u32 = struct.Struct("=I")
+
+def _align(n):
+    return (n + 3) & ~3
+
+def packAttributes(attrs):
+    r = []
+    for type, value in attrs:
+        n = rtattr.size + len(value)
+        r += rtattr.pack(n, type), value, '\0' * (_align(n) - n)
+    return ''.join(r)
+
+def unpackAttributes(data, offset=0):
+    r = {}
+    end = len(data)
+    while offset + rtattr.size <= end:
+        n, type = rtattr.unpack_from(data, offset)
+        if n < rtattr.size:
+            break
+        r[type] = data[offset+rtattr.size:offset+n]
+        offset += _align(n)
+    return r
+
+
+Route = namedtuple("Route", "family dst_len src_len tos table protocol"
+                            " scope type flags attrs")
+
+def packRoute(family, dst_len, flags=0, attrs=(), table=0, protocol=0,
+              scope=0, type=0):
+    return rtmsg.pack(family, dst_len, 0, 0, table, protocol,
+                      scope, type, flags) + packAttributes(attrs)
+
+def unpackRoute(data):
+    return Route(*rtmsg.unpack_from(data) + (
+        unpackAttributes(data, rtmsg.size),))
+
+
+def ifindex(name):
+    s = socket.socket()
+    try:
+        return struct.unpack_from("16xi", fcntl.ioctl(s, SIOCGIFINDEX,
+                                  struct.pack("16si", name, 0)))[0]
+    finally:
+        s.close()
+
+# The following functions return messages to add or delete objects,
+# to be passed to Netlink.call or Netlink.check_call. Addresses are packed
+# (as returned by socket.inet_pton).
+
+def route(add, family, dst, dst_len, gateway=None, oif=None,
+          type=RTN_UNICAST, protocol=RTPROT_BOOT):
+    """Route in the main table, like 'ip route add|del'"""
+    attrs = []
+    if dst_len:
+        attrs.append((RTA_DST, dst))
+    if gateway:
+        attrs.append((RTA_GATEWAY, gateway))
+    if oif:
+        attrs.append((RTA_OIF, u32.pack(oif)))
+    if not add:
+        return RTM_DELROUTE, 0, packRoute(family, dst_len, 0, attrs,
+            RT_TABLE_MAIN, 0, RT_SCOPE_NOWHERE, type)
+    return RTM_NEWROUTE, NLM_F_CREATE | NLM_F_EXCL, packRoute(
+        family, dst_len, 0, attrs, RT_TABLE_MAIN, protocol,
+        RT_SCOPE_LINK if type == RTN_UNICAST and not gateway else
+        RT_SCOPE_UNIVERSE, type)
+
+def address(add, family, address, prefixlen, index):
+    """Like 'ip address add|del'"""
+    return ((RTM_NEWADDR, NLM_F_CREATE | NLM_F_EXCL) if add else
+            (RTM_DELADDR, 0)) + (
+        ifaddrmsg.pack(family, prefixlen, 0, RT_SCOPE_UNIVERSE, index)
+        + packAttributes(((IFA_LOCAL, address), (IFA_ADDRESS, address))),)
+
+def addrlabel(add, prefix, prefixlen, label):
+    """Like 'ip addrlabel add|del' (IPv6 only)"""
+    return ((RTM_NEWADDRLABEL, NLM_F_CREATE | NLM_F_EXCL) if add else
+            (RTM_DELADDRLABEL, 0)) + (
+        ifaddrlblmsg.pack(socket.AF_INET6, 0, prefixlen, 0, 0, 0)
+        + packAttributes(((IFAL_ADDRESS, prefix),
+                          (IFAL_LABEL, u32.pack(label)))),)
+
+
+class NetlinkError(EnvironmentError):
+    pass
+
+
+class Netlink(object):
+    """rtnetlink socket
+
+    Requests are identified by their sequence number. Replies, as well as
+    notifications of subscribed multicast groups, are got with 'recv'.
+
+    A blocking socket can also be used for synchronous requests: see
+    'call', 'check_call' and 'dump'.
+    """
+
+    def __init__(self, groups=0, blocking=False):
+        s = self.socket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                        NETLINK_ROUTE)
+        s.bind((0, groups))
+        s.setblocking(blocking)
+        self._seq = 0
+
+    def close(self):
+        self.socket.close()
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def _pack(self, type, flags, data):
+        self._seq = seq = self._seq + 1
+        return seq, nlmsghdr.pack(nlmsghdr.size + len(data), type,
+                                  flags | NLM_F_REQUEST, seq, 0) + data
+
+    def send(self, type, flags, data):
+        seq, msg = self._pack(type, flags, data)
+        self.socket.send(msg)
+        return seq
+
+    def call(self, *messages):
+        """Send (type, flags, data) messages at once and wait for the result
+
+        Return a list with the errno of each message (0 for success).
+        """
+        seq_list = []
+        msg = []
+        for type, flags, data in messages:
+            seq, x = self._pack(type, flags | NLM_F_ACK, data)
+            seq_list.append(seq)
+            msg.append(x)
+        self.socket.send(''.join(msg))
+        result = dict.fromkeys(seq_list)
+        pending = len(seq_list)
+        while pending:
+            for type, flags, seq, data in self.recv():
+                if type == NLMSG_ERROR and result.get(seq, 0) is None:
+                    result[seq] = data
+                    pending -= 1
+        return [result[seq] for seq in seq_list]
+
+    def check_call(self, *messages):
+        """Same as 'call' but raise NetlinkError for the first failure"""
+        for e in self.call(*messages):
+            if e:
+                raise NetlinkError(e, os.strerror(e))
+
+    def dump(self, type, data):
+        """Return the list of data of all objects of the given type"""
+        seq = self.send(type, NLM_F_DUMP, data)
+        r = []
+        while True:
+            for type, flags, x, data in self.recv():
+                if x == seq:
+                    if type == NLMSG_DONE:
+                        return r
+                    if type == NLMSG_ERROR:
+                        raise NetlinkError(data, os.strerror(data))
+                    r.append(data)
+
+    def recv(self):
+        """Return received messages as a list of (type, flags, seq, data)
+
+        For NLMSG_ERROR, data is the (positive) errno, 0 for an ACK.
+        An empty list is returned if there's nothing to read.
+        """
+        try:
+            data = self.socket.recv(65536)
+        except socket.error, e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        r = []
+        offset = 0
+        end = len(data)
+        while offset + nlmsghdr.size <= end:
+            n, type, flags, seq, _ = nlmsghdr.unpack_from(data, offset)
+            if n < nlmsghdr.size:
+                break
+            x = offset + nlmsghdr.size
+            if type == NLMSG_ERROR:
+                x = -nlmsgerr.unpack_from(data, x)[0]
+            else:
+                x = data[x:offset+n]
+            r.append((type, flags, seq, x))
+            offset += _align(n)
+        return r
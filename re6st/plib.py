@@ -1,8 +1,7 @@
-import logging, errno, os
+import logging, errno, fcntl, os, socket
 from . import utils
 
 here = os.path.realpath(os.path.dirname(__file__))
-ovpn_server = os.path.join(here, 'ovpn-server')
 ovpn_client = os.path.join(here, 'ovpn-client')
 ovpn_log = None
 
@@ -25,8 +24,8 @@ def openvpn(iface, encrypt, *args, **kw):
 
 ovpn_link_mtu_dict = {'udp': 1434, 'udp6': 1450}
 
-def server(iface, max_clients, dh_path, fd, port, proto, encrypt, *args, **kw):
-    client_script = '%s %s' % (ovpn_server, fd)
+def server(iface, max_clients, dh_path, management, port, proto, encrypt,
+           *args, **kw):
     try:
         args = ('--link-mtu', str(ovpn_link_mtu_dict[proto]),
                 # mtu-disc ignored for udp6 due to a bug in OpenVPN
@@ -36,13 +35,12 @@ def server(iface, max_clients, dh_path, fd, port, proto, encrypt, *args, **kw):
     return openvpn(iface, encrypt,
         '--tls-server',
         '--mode', 'server',
-        '--client-connect', client_script,
-        '--client-disconnect', client_script,
+        '--management-client-auth',
         '--dh', dh_path,
         '--max-clients', str(max_clients),
         '--port', str(port),
         '--proto', proto,
-        *args, **kw)
+        *management.args + args, **kw)
 
 
 def client(iface, address_list, encrypt, *args, **kw):
@@ -59,6 +57,132 @@ def client(iface, address_list, encrypt, *args, **kw):
     return openvpn(iface, encrypt, *remote, **kw)
 
 
+def _cloexec(s):
+    fd = s.fileno()
+    fcntl.fcntl(fd, fcntl.F_SETFD,
+                fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+class Management(object):
+    """Management interface of an OpenVPN process
+
+    We listen on a unix socket and OpenVPN connects to it (see 'args').
+    Real-time notifications are read from the event loop and passed to
+    'callback' with this object, their name and their arguments, e.g.
+    'STATE' and '1407839372,CONNECTED,SUCCESS,,'. For '>CLIENT:' ones, the
+    callback is only called once the environment is complete, with a name
+    like 'CLIENT:CONNECT', a list of arguments and the environment as a dict.
+
+    'commands' are sent each time OpenVPN connects. The socket is
+    non-blocking and commands are queued, so that a stalled OpenVPN does
+    not block the event loop.
+    """
+
+    socket = None
+
+    def __init__(self, path, loop, callback, *commands):
+        self.args = '--management', path, 'unix', '--management-client'
+        self._loop = loop
+        self._callback = callback
+        self._commands = commands
+        try:
+            os.remove(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        s = self._listen = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        _cloexec(s)
+        s.bind(path)
+        s.listen(1)
+        loop.addReader(s, self._accept)
+
+    def close(self):
+        self._disconnect()
+        self._loop.removeReader(self._listen)
+        self._listen.close()
+
+    def _accept(self):
+        s = self._listen.accept()[0]
+        _cloexec(s)
+        s.setblocking(0)
+        self._disconnect()
+        self.socket = s
+        self._buffer = ''
+        self._output = []
+        self._client = None
+        self._loop.addReader(s, self._read)
+        if self._commands:
+            self.send(*self._commands)
+
+    def _disconnect(self):
+        s = self.socket
+        if s:
+            self.socket = None
+            self._loop.removeReader(s)
+            self._loop.removeWriter(s)
+            s.close()
+
+    def send(self, *lines):
+        if self.socket is None:
+            logging.info("Failed to send %r to OpenVPN management"
+                         " (not connected)", lines)
+            return
+        output = self._output
+        output.append(''.join(x + '\n' for x in lines))
+        if len(output) == 1:
+            self._write()
+
+    def _write(self):
+        output = self._output
+        data = ''.join(output)
+        try:
+            n = self.socket.send(data)
+        except socket.error, e:
+            if e.errno != errno.EAGAIN:
+                logging.info("OpenVPN management: %s", e)
+                return self._disconnect()
+            n = 0
+        del output[:]
+        if n < len(data):
+            output.append(data[n:])
+            self._loop.addWriter(self.socket, self._write)
+        else:
+            self._loop.removeWriter(self.socket)
+
+    def _read(self):
+        try:
+            data = self.socket.recv(65536)
+        except socket.error, e:
+            if e.errno == errno.EAGAIN:
+                return
+            logging.info("OpenVPN management: %s", e)
+            data = None
+        if not data:
+            return self._disconnect()
+        lines = (self._buffer + data).split('\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            line = line.rstrip('\r')
+            if line[:1] == '>':
+                name, _, args = line[1:].partition(':')
+                if name == 'CLIENT':
+                    name, _, args = args.partition(',')
+                    if name == 'ENV':
+                        client = self._client
+                        if client:
+                            if args == 'END':
+                                self._client = None
+                                self._callback(self, *client)
+                            else:
+                                k, _, v = args.partition('=')
+                                client[2][k] = v
+                    elif name != 'ADDRESS':
+                        self._client = 'CLIENT:' + name, args.split(','), {}
+                    continue
+                self._callback(self, name, args)
+            elif line.startswith('ERROR:'):
+                logging.error("OpenVPN management: %s", line)
+
+
 def router(ip, ip4, src, hello_interval, log_path, state_path,
            pidfile, control_socket, default, *args, **kw):
     ip, n = ip
@@ -21,10 +21,11 @@ Authenticated communication:
 import base64, hmac, hashlib, httplib, inspect, json, logging
 import mailbox, os, random, select, smtplib, socket, sqlite3
 import string, struct, sys, threading, time, weakref, zlib
-from collections import defaultdict, deque
+from collections import defaultdict, deque, OrderedDict
 from datetime import datetime
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 from email.mime.text import MIMEText
+from heapq import heappop, heappush
 from operator import itemgetter
 from OpenSSL import crypto
 from urllib import splittype, splithost, unquote, urlencode
@@ -45,15 +46,244 @@ class HTTPError(Exception):
     pass
 
 
+class Babel(ctl.Babel):
+
+    def _read(self):
+        # Unlike nodes, the registry must survive a restart of babeld.
+        try:
+            ctl.Babel._read(self)
+        except ctl.ConnectionClosed, e:
+            logging.warning("%s", e)
+            self.handler.babel_reset()
+
+
+class SessionStore(object):
+    """HMAC secrets of authenticated clients, indexed by CN
+
+    See module docstring about the protocol. Sessions are split in shards,
+    each one with its own lock, so that authentication never waits for
+    other RPCs (and in particular not for the registry lock). HMAC objects
+    are prepared once for each secret. Sessions that are idle for more than
+    'timeout' seconds are dropped, as well as the least recently used ones
+    when a shard is full.
+    """
+
+    shards = 16
+
+    def __init__(self, max_size, timeout):
+        self.max_size = max(1, max_size // self.shards)
+        self.timeout = timeout
+        self._shards = [_SessionShard() for _ in xrange(self.shards)]
+
+    def _shard(self, cn):
+        return self._shards[hash(cn) % self.shards]
+
+    def hello(self, cn, secret):
+        """Add a secret, keeping the last used one until the new one is"""
+        s = self._shard(cn)
+        now = time.time()
+        secret = secret, hmac.HMAC(secret, None, hashlib.sha1)
+        with s.lock:
+            s.handshakes += 1
+            session = s.sessions.pop(cn, None)
+            s.sessions[cn] = now, (session[1][0], secret) if session else (
+                secret,)
+            self._evict(s, now)
+
+    def _evict(self, s, now):
+        sessions = s.sessions
+        # Sessions are ordered by last use.
+        while sessions:
+            cn = next(iter(sessions))
+            if (now - sessions[cn][0] < self.timeout and
+                len(sessions) <= self.max_size):
+                break
+            del sessions[cn]
+            s.evictions += 1
+
+    def authenticate(self, cn, path, h):
+        """Check the HMAC of a request, and return the key for the response
+
+        None is returned if the session is unknown or if the HMAC is wrong.
+        """
+        s = self._shard(cn)
+        now = time.time()
+        with s.lock:
+            try:
+                t, secrets = session = s.sessions.pop(cn)
+            except KeyError:
+                s.misses += 1
+                return
+            if now - t < self.timeout:
+                for secret, x in secrets:
+                    x = x.copy()
+                    x.update(path)
+                    if h == x.digest():
+                        key = hashlib.sha1(secret).digest()
+                        secret = hashlib.sha1(key).digest()
+                        s.sessions[cn] = now, ((secret,
+                            hmac.HMAC(secret, None, hashlib.sha1)),)
+                        s.hits += 1
+                        return key
+                s.sessions[cn] = session
+            else:
+                s.evictions += 1
+            s.misses += 1
+
+    def remove(self, cn):
+        s = self._shard(cn)
+        with s.lock:
+            s.sessions.pop(cn, None)
+
+    def stats(self):
+        r = dict.fromkeys(('sessions', 'hits', 'misses', 'handshakes',
+                           'evictions'), 0)
+        for s in self._shards:
+            with s.lock:
+                r['sessions'] += len(s.sessions)
+                for k in 'hits', 'misses', 'handshakes', 'evictions':
+                    r[k] += getattr(s, k)
+        return r
+
+class _SessionShard(object):
+
+    hits = misses = handshakes = evictions = 0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # {cn: (last use, ((secret, hmac), ...))}
+        self.sessions = OrderedDict()
+
+
+class PrefixPool(object):
+    """Buddy allocator of client prefixes
+
+    Rows of the 'cert' table are the leaves of a binary tree that covers
+    the network. Free leaves (without certificate) are indexed in memory by
+    length, and the smallest one that is big enough is split on allocation.
+    A freed leaf is merged with its buddy as long as the latter is free.
+
+    Changes to the database must be done within a 'with pool, db:' block,
+    so that the pool is reverted if the transaction is rolled back.
+    """
+
+    _undo = None
+
+    def __init__(self, db, max_len):
+        self.db = db
+        self.max_len = max_len
+        self.load()
+
+    def load(self):
+        # For each length: heap of values (possibly with removed or
+        # duplicate values) and set of free values.
+        self._free = [([], set()) for _ in xrange(self.max_len + 1)]
+        for prefix, in self.db.execute(
+                "SELECT prefix FROM cert WHERE cert IS NULL").fetchall():
+            # BBB: slots were not merged in the past.
+            self.free(utils.Prefix.fromStr(prefix))
+
+    def __enter__(self):
+        assert self._undo is None
+        self._undo = []
+
+    def __exit__(self, t, v, tb):
+        undo = self._undo
+        del self._undo
+        if t is not None:
+            for added, value, length in reversed(undo):
+                if added:
+                    self._free[length][1].remove(value)
+                else:
+                    self._add(value, length)
+
+    def _add(self, value, length):
+        heap, free = self._free[length]
+        free.add(value)
+        if self._undo is not None:
+            self._undo.append((True, value, length))
+        if len(heap) > 2 * len(free) + 64:
+            heap[:] = sorted(free)
+        else:
+            heappush(heap, value)
+
+    def allocate(self, prefix_len):
+        assert 0 < prefix_len <= self.max_len
+        for length in xrange(prefix_len, -1, -1):
+            heap, free = self._free[length]
+            while heap:
+                value = heappop(heap)
+                if value in free:
+                    free.remove(value)
+                    if self._undo is not None:
+                        self._undo.append((False, value, length))
+                    break
+            else:
+                continue
+            break
+        else:
+            logging.error('No more free /%u prefix available', prefix_len)
+            raise StopIteration
+        q = self.db.execute
+        prefix = utils.Prefix((value, length))
+        if length < prefix_len:
+            value <<= prefix_len - length
+            for length in xrange(length + 1, prefix_len + 1):
+                x = value >> prefix_len - length | 1
+                q("INSERT INTO cert (prefix) VALUES (?)",
+                  (utils.Prefix((x, length)),))
+                self._add(x, length)
+            q("UPDATE cert SET prefix=? WHERE prefix=?",
+              (utils.Prefix((value, length)), prefix))
+            prefix = utils.Prefix((value, length))
+        if length < self.max_len or value:
+            return prefix
+        q("UPDATE cert SET cert='reserved' WHERE prefix=?", (prefix,))
+        return self.allocate(prefix_len)
+
+    def free(self, prefix):
+        """Release a prefix whose row has no certificate anymore"""
+        value, length = prefix
+        q = self.db.execute
+        while length:
+            free = self._free[length][1]
+            buddy = value ^ 1
+            if buddy not in free:
+                break
+            free.remove(buddy)
+            if self._undo is not None:
+                self._undo.append((False, buddy, length))
+            q("DELETE FROM cert WHERE prefix IN (?,?)",
+              (utils.Prefix((value, length)), utils.Prefix((buddy, length))))
+            value >>= 1
+            length -= 1
+            q("INSERT INTO cert (prefix) VALUES (?)",
+              (utils.Prefix((value, length)),))
+        self._add(value, length)
+
+
 class RegistryServer(object):
 
     peers = 0, ()
     cert_duration = 365 * 86400
+    # Number of CRL versions for which changes are kept.
+    crl_delta_size = 1000
+    # Number of network versions for which the config is kept in memory.
+    config_history_size = 16
+    _timeout = _babel_timeout = None
+    _next_timeout = float('inf')
+    _timeout_update = False
+    # Snapshot of Babel routes: (date, set of prefixes)
+    _babel_peers = 0, frozenset()
+    _babel_refresh = False
 
-    def __init__(self, config):
+    def __init__(self, config, loop):
         self.config = config
+        self._loop = loop
         self.lock = threading.Lock()
-        self.sessions = {}
+        self.sessions = SessionStore(config.max_sessions,
+                                     config.session_timeout)
+        self._config_history = OrderedDict()
         self.sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
 
         # Database initializing
@@ -66,22 +296,46 @@ class RegistryServer(object):
                 "name TEXT PRIMARY KEY NOT NULL",
                 "value")
         self.prefix = self.getConfig("prefix", None)
+        if self.prefix is not None:
+            self.prefix = utils.Prefix.fromStr(self.prefix)
         self.version = str(self.getConfig("version", "\0")) # BBB: blob
         utils.sqliteCreateTable(self.db, "token",
                 "token TEXT PRIMARY KEY NOT NULL",
                 "email TEXT NOT NULL",
                 "prefix_len INTEGER NOT NULL",
                 "date INTEGER NOT NULL")
-        if utils.sqliteCreateTable(self.db, "cert",
-                "prefix TEXT PRIMARY KEY NOT NULL",
-                "email TEXT",
-                "cert TEXT"):
-            self.db.execute("INSERT INTO cert VALUES ('',null,null)")
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS token_date ON token(date)")
+        with self.db:
+            self.db.execute("BEGIN")
+            self._createCertTable()
         utils.sqliteCreateTable(self.db, "crl",
                 "serial INTEGER PRIMARY KEY NOT NULL",
                 # Expiration date of revoked certificate.
-                # TODO: purge rows with dates in the past.
                 "date INTEGER NOT NULL")
+        self.db.execute("CREATE INDEX IF NOT EXISTS crl_date ON crl(date)")
+        with self.db:
+            self.db.execute("BEGIN")
+            if utils.sqliteCreateTable(self.db, "crl_delta",
+                    # Changes of the CRL, so that nodes can only download
+                    # what they don't know yet.
+                    "version INTEGER NOT NULL",
+                    "serial INTEGER NOT NULL",
+                    "revoked INTEGER NOT NULL"):
+                # Nodes start at version 0 so this forces a full download
+                # (with BBB, there may already be revoked certificates).
+                self.setConfig('crl_version', 1)
+                self.setConfig('crl_first', 1)
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS crl_delta_version ON crl_delta(version)")
+        with self.db:
+            self.db.execute("BEGIN")
+            if utils.sqliteCreateTable(self.db, "subject_serial",
+                    # Free numbers below the greatest allocated one
+                    # have a null prefix.
+                    "serial INTEGER PRIMARY KEY NOT NULL",
+                    "prefix TEXT UNIQUE"):
+                self._initSubjectSerial()
 
         self.cert = x509.Cert(self.config.ca, self.config.key)
         # Get vpn network prefix
@@ -89,10 +343,21 @@ class RegistryServer(object):
         logging.info("Network: %s/%u", utils.ipFromBin(self.network),
                                        len(self.network))
         self.email = self.cert.ca.get_subject().emailAddress
+        with self.db:
+            self.db.execute("BEGIN")
+            self.prefix_pool = PrefixPool(self.db, 128 - len(self.network))
 
         self.peers_lock = threading.Lock()
-        self.ctl = ctl.Babel(os.path.join(config.run, 'babeld.sock'),
-            weakref.proxy(self), self.network)
+        self._babel_cond = threading.Condition()
+        # Babel is only queried by the main thread, which is woken up by
+        # worker threads with this pipe. See getPeers.
+        self._babel_wakeup = os.pipe()
+        loop.addReader(self._babel_wakeup[0], self._requestDump)
+        # Same for the timer of onTimeout. See scheduleTimeout.
+        self._timeout_wakeup = os.pipe()
+        loop.addReader(self._timeout_wakeup[0], self._setTimeout)
+        self.ctl = Babel(os.path.join(config.run, 'babeld.sock'),
+            weakref.proxy(self), self.network, loop)
 
         self.onTimeout()
         if self.prefix:
@@ -108,14 +373,31 @@ class RegistryServer(object):
         self.db.execute("INSERT OR REPLACE INTO config VALUES (?, ?)",
                         name_value)
 
+    def updateCrl(self, revoked=(), removed=()):
+        version = 1 + self.getConfig('crl_version')
+        self.setConfig('crl_version', version)
+        self.db.executemany("INSERT INTO crl_delta VALUES (?,?,?)",
+            [(version, x, 1) for x in revoked] +
+            [(version, x, 0) for x in removed])
+        first = version - self.crl_delta_size
+        if self.getConfig('crl_first') < first:
+            self.db.execute("DELETE FROM crl_delta WHERE version <= ?",
+                            (first,))
+            self.setConfig('crl_first', first)
+        self.updateNetworkConfig()
+
     def updateNetworkConfig(self, _it0=itemgetter(0)):
+        crl = map(_it0, self.db.execute(
+            "SELECT serial FROM crl ORDER BY serial"))
         kw = {
             'babel_default': 'max-rtt-penalty 5000 rtt-max 500 rtt-decay 125',
-            'crl': map(_it0, self.db.execute(
-                "SELECT serial FROM crl ORDER BY serial")),
+            'crl': crl,
+            'crl_version': self.getConfig('crl_version'),
             'protocol': version.protocol,
             'registry_prefix': self.prefix,
         }
+        if self.prefix is not None:
+            kw['registry_prefix'] = str(self.prefix)
         if self.config.ipv4:
             kw['ipv4'], kw['ipv4_sublen'] = self.config.ipv4
         for x in ('client_count', 'encrypt', 'hello',
@@ -135,6 +417,15 @@ class RegistryServer(object):
         # kw['delay_restart'] = 600 * random.random()
         kw['version'] = self.version.encode('base64')
         self.network_config = zlib.compress(json.dumps(kw))
+        del kw['crl']
+        # For getNetworkConfigDelta: config without CRL, full CRL,
+        # and responses by versions of config and CRL.
+        self._network_config_delta = kw, crl, {}
+        history = self._config_history
+        history.pop(self.version, None)
+        history[self.version] = kw
+        if len(history) > self.config_history_size:
+            history.popitem(False)
 
     # The 3 first bits code the number of bytes.
     def encodeVersion(self, version):
@@ -157,7 +448,7 @@ class RegistryServer(object):
     def recv(self, code):
         try:
             prefix, msg = self.sock.recv(1<<16).split('\0', 1)
-            int(prefix, 2)
+            prefix = utils.Prefix.fromStr(prefix)
         except ValueError:
             pass
         else:
@@ -165,74 +456,163 @@ class RegistryServer(object):
                 return prefix, msg[1:]
         return None, None
 
-    def select(self, r, w, t):
-        if self.timeout:
-            t.append((self.timeout, self.onTimeout))
-
-    def request_dump(self):
-        assert self.peers_lock.locked()
-        def abort():
-            raise ctl.BabelException
-        self._wait_dump = True
-        for _ in 0, 1:
-            self.ctl.request_dump()
-            try:
-                while self._wait_dump:
-                    args = {}, {}, ((time.time() + 5, abort),)
-                    self.ctl.select(*args)
-                    utils.select(*args)
-                break
-            except ctl.BabelException:
-                self.ctl.reset()
+    def scheduleTimeout(self, when):
+        # RPCs are processed by worker threads, and the event loop is not
+        # thread-safe: the timer is set by the main thread, which is woken
+        # up because it may be waiting for an earlier date, or forever.
+        assert self.lock.locked()
+        if when < self._next_timeout:
+            self._next_timeout = when
+            if not self._timeout_update:
+                self._timeout_update = True
+                os.write(self._timeout_wakeup[1], '\0')
+
+    def _setTimeout(self):
+        os.read(self._timeout_wakeup[0], 4096)
+        with self.lock:
+            self._timeout_update = False
+            when = self._next_timeout
+        timer = self._timeout
+        if timer is not None and timer.pending:
+            if timer.when == when:
+                return
+            timer.cancel()
+        self._timeout = self._loop.at(when, self.onTimeout)
+
+    def getPeers(self):
+        """Return the set of prefixes that are routed by Babel
+
+        All threads share a snapshot that is taken by the main thread.
+        If it's older than --babel-ttl, a refresh is requested but the
+        snapshot is returned anyway, so that no request waits for babeld,
+        except at startup.
+        """
+        cond = self._babel_cond
+        with cond:
+            t, peers = self._babel_peers
+            if t + self.config.babel_ttl < time.time():
+                if not self._babel_refresh:
+                    self._babel_refresh = True
+                    os.write(self._babel_wakeup[1], '\0')
+                if not t:
+                    cond.wait(5)
+                    t, peers = self._babel_peers
+        return peers
+
+    def _requestDump(self):
+        os.read(self._babel_wakeup[0], 4096)
+        self._babel_timeout = self._loop.at(time.time() + 5,
+                                            self._babelTimeout)
+        self.ctl.request_dump()
+
+    def _babelTimeout(self):
+        logging.warning("No reply from babeld: reconnecting")
+        self.babel_reset()
+
+    def babel_reset(self):
+        """Forget the connection to babeld, until the next refresh"""
+        self._babel_timeout.cancel()
+        self.ctl.reset()
+        with self._babel_cond:
+            self._babel_refresh = False
 
     def babel_dump(self):
-        self._wait_dump = False
+        self._babel_timeout.cancel()
+        peers = frozenset(prefix
+            for neigh_routes in self.ctl.neighbours.itervalues()
+            for prefix in neigh_routes[1]
+            if prefix)
+        with self._babel_cond:
+            self._babel_peers = time.time(), peers
+            self._babel_refresh = False
+            self._babel_cond.notify_all()
+
+    def _createCertTable(self):
+        columns = ("prefix TEXT PRIMARY KEY NOT NULL",
+                   "email TEXT",
+                   "cert TEXT",
+                   # Serial and expiration date of 'cert', for indexed
+                   # lookups. Null if there's no certificate.
+                   "serial INTEGER",
+                   "not_after INTEGER")
+        q = self.db.execute
+        try:
+            if utils.sqliteCreateTable(self.db, "cert", *columns):
+                q("INSERT INTO cert (prefix) VALUES ('')")
+        except sqlite3.OperationalError:
+            # BBB: serial & not_after were only stored in certificates.
+            q("ALTER TABLE cert RENAME TO cert_old")
+            utils.sqliteCreateTable(self.db, "cert", *columns)
+            for prefix, email, cert in q(
+                    "SELECT prefix, email, cert FROM cert_old").fetchall():
+                serial = not_after = None
+                if cert:
+                    try:
+                        x = crypto.load_certificate(crypto.FILETYPE_PEM, cert)
+                    except crypto.Error:
+                        pass
+                    else:
+                        serial = x.get_serial_number()
+                        not_after = x509.notAfter(x)
+                q("INSERT INTO cert VALUES (?,?,?,?,?)",
+                  (prefix, email, cert, serial, not_after))
+            q("DROP TABLE cert_old")
+        q("CREATE INDEX IF NOT EXISTS cert_serial ON cert(serial)")
+        q("CREATE INDEX IF NOT EXISTS cert_not_after ON cert(not_after)")
 
     def iterCert(self):
         for prefix, email, cert in self.db.execute(
-                "SELECT * FROM cert WHERE cert IS NOT NULL"):
+                "SELECT prefix, email, cert FROM cert"
+                " WHERE cert IS NOT NULL"):
             try:
                 yield (crypto.load_certificate(crypto.FILETYPE_PEM, cert),
-                       prefix, email)
+                       utils.Prefix.fromStr(prefix), email)
             except crypto.Error:
                 pass
 
     def onTimeout(self):
-        # XXX: Because we use threads to process requests, the statements
-        #      'self.timeout = 1' below have no effect as long as the
-        #      'select' call does not return. Ideally, we should interrupt it.
-        logging.info("Checking if there's any old entry in the database ...")
-        not_after = None
-        old = time.time() - GRACE_PERIOD
+        logging.info("Checking if there's any old entry in the database ..."
+                     " (sessions: %s)", ', '.join('%s=%s' % x
+                         for x in sorted(self.sessions.stats().iteritems())))
+        now = time.time()
+        old = now - GRACE_PERIOD
         q =  self.db.execute
         with self.lock:
-          with self.db:
+          self._next_timeout = float('inf') # computed again below
+          with self.prefix_pool, self.db:
             q("BEGIN")
-            for token, x in q("SELECT token, date FROM token"):
-                if x <= old:
-                    q("DELETE FROM token WHERE token=?", (token,))
-                elif not_after is None or x < not_after:
-                    not_after = x
-            for cert, prefix, email in self.iterCert():
-                x = x509.notAfter(cert)
-                if x <= old:
-                    if prefix == self.prefix:
-                        logging.critical("Refuse to delete certificate"
-                                         " of main node: wrong clock ?")
-                        sys.exit(1)
-                    logging.info("Delete %s: %s (invalid since %s)",
-                        "certificate requested by '%s'" % email
-                        if email else "anonymous certificate",
-                        ", ".join("%s=%s" % x for x in
-                                  cert.get_subject().get_components()),
-                        datetime.utcfromtimestamp(x).isoformat())
-                    q("UPDATE cert SET email=null, cert=null WHERE prefix=?",
-                      (prefix,))
-                elif not_after is None or x < not_after:
-                    not_after = x
-            # TODO: reduce 'cert' table by merging free slots
-            #       (IOW, do the contrary of newPrefix)
-            self.timeout = not_after and not_after + GRACE_PERIOD
+            # Expired certificates are rejected anyway.
+            removed = [x for x, in q("SELECT serial FROM crl WHERE date <= ?",
+                                     (now,))]
+            if removed:
+                q("DELETE FROM crl WHERE date <= ?", (now,))
+                self.updateCrl(removed=removed)
+            q("DELETE FROM token WHERE date <= ?", (old,))
+            # Fetch all rows before deleting, because slots are merged.
+            for prefix, email, cert, x in q(
+                    "SELECT prefix, email, cert, not_after FROM cert"
+                    " WHERE not_after <= ?", (old,)).fetchall():
+                prefix = utils.Prefix.fromStr(prefix)
+                if prefix == self.prefix:
+                    logging.critical("Refuse to delete certificate"
+                                     " of main node: wrong clock ?")
+                    sys.exit(1)
+                cert = crypto.load_certificate(crypto.FILETYPE_PEM, cert)
+                logging.info("Delete %s: %s (invalid since %s)",
+                    "certificate requested by '%s'" % email
+                    if email else "anonymous certificate",
+                    ", ".join("%s=%s" % x for x in
+                              cert.get_subject().get_components()),
+                    datetime.utcfromtimestamp(x).isoformat())
+                self.deleteCert(prefix)
+            not_after, = q("SELECT min(x) FROM ("
+                " SELECT min(date) AS x FROM token UNION ALL"
+                " SELECT min(not_after) FROM cert)").next()
+            if not_after:
+                self.scheduleTimeout(not_after + GRACE_PERIOD)
+            not_after, = q("SELECT min(date) FROM crl").next()
+            if not_after:
+                self.scheduleTimeout(not_after)
 
     def handle_request(self, request, method, kw,
                        _localhost=('127.0.0.1', '::1')):
@@ -244,16 +624,10 @@ class RegistryServer(object):
                 return request.send_error(httplib.FORBIDDEN)
         key = m.getcallargs(**kw).get('cn')
         if key:
-            h = base64.b64decode(request.headers[HMAC_HEADER])
-            with self.lock:
-                session = self.sessions[key]
-                for key in session:
-                    if h == hmac.HMAC(key, request.path, hashlib.sha1).digest():
-                        break
-                else:
-                    raise Exception("Wrong HMAC")
-                key = hashlib.sha1(key).digest()
-                session[:] = hashlib.sha1(key).digest(),
+            key = self.sessions.authenticate(key, request.path,
+                base64.b64decode(request.headers[HMAC_HEADER]))
+            if not key:
+                raise Exception("Wrong HMAC")
         try:
             result = m(**kw)
         except HTTPError, e:
@@ -277,8 +651,8 @@ class RegistryServer(object):
     def hello(self, client_prefix):
         with self.lock:
             cert = self.getCert(client_prefix)
-            key = utils.newHmacSecret()
-            self.sessions.setdefault(client_prefix, [])[1:] = key,
+        key = utils.newHmacSecret()
+        self.sessions.hello(client_prefix, key)
         key = x509.encrypt(cert, key)
         sign = self.cert.sign(key)
         assert len(key) == len(sign)
@@ -306,7 +680,7 @@ class RegistryServer(object):
                     break
                 except sqlite3.IntegrityError:
                     pass
-            self.timeout = 1
+            self.scheduleTimeout(args[3] + GRACE_PERIOD)
 
         # Creating and sending email
         msg = MIMEText('Hello, your token to join re6st network is: %s\n'
@@ -328,29 +702,11 @@ class RegistryServer(object):
             s.sendmail(self.email, email, msg.as_string())
             s.quit()
 
-    def newPrefix(self, prefix_len):
-        max_len = 128 - len(self.network)
-        assert 0 < prefix_len <= max_len
-        try:
-            prefix, = self.db.execute("""SELECT prefix FROM cert WHERE length(prefix) <= ? AND cert is null
-                                         ORDER BY length(prefix) DESC""", (prefix_len,)).next()
-        except StopIteration:
-            logging.error('No more free /%u prefix available', prefix_len)
-            raise
-        while len(prefix) < prefix_len:
-            self.db.execute("UPDATE cert SET prefix = ? WHERE prefix = ?", (prefix + '1', prefix))
-            prefix += '0'
-            self.db.execute("INSERT INTO cert VALUES (?,null,null)", (prefix,))
-        if len(prefix) < max_len or '1' in prefix:
-            return prefix
-        self.db.execute("UPDATE cert SET cert = 'reserved' WHERE prefix = ?", (prefix,))
-        return self.newPrefix(prefix_len)
-
     @rpc
     def requestCertificate(self, token, req):
         req = crypto.load_certificate_request(crypto.FILETYPE_PEM, req)
         with self.lock:
-            with self.db:
+            with self.prefix_pool, self.db:
                 if token:
                     if not self.config.prefix_length:
                         raise HTTPError(httplib.FORBIDDEN)
@@ -367,7 +723,7 @@ class RegistryServer(object):
                     if not prefix_len:
                         raise HTTPError(httplib.FORBIDDEN)
                     email = None
-                prefix = self.newPrefix(prefix_len)
+                prefix = self.prefix_pool.allocate(prefix_len)
                 self.db.execute("UPDATE cert SET email = ? WHERE prefix = ?",
                                 (email, prefix))
                 if self.prefix is None:
@@ -375,21 +731,40 @@ class RegistryServer(object):
                     self.setConfig('prefix', prefix)
                     self.updateNetworkConfig()
                 subject = req.get_subject()
-                subject.serialNumber = str(self.getSubjectSerial())
+                subject.serialNumber = str(self.getSubjectSerial(prefix))
                 return self.createCertificate(prefix, subject, req.get_pubkey())
 
-    def getSubjectSerial(self):
-        # Smallest unique number, for IPv4 support.
-        serials = []
-        for x in self.iterCert():
-            serial = x[0].get_subject().serialNumber
+    def _initSubjectSerial(self):
+        # BBB: subject serials used to be only stored in certificates.
+        serials = {}
+        for cert, prefix, email in self.iterCert():
+            serial = cert.get_subject().serialNumber
             if serial:
-                serials.append(int(serial))
-        serials.sort()
-        for serial, x in enumerate(serials):
-            if serial != x:
-                return serial
-        return len(serials)
+                serials[int(serial)] = prefix
+        if serials:
+            logging.info("Indexing %u subject serials ...", len(serials))
+            self.db.executemany("INSERT INTO subject_serial VALUES (?,?)",
+                ((x, serials.get(x)) for x in xrange(1 + max(serials))))
+
+    def getSubjectSerial(self, prefix):
+        # Smallest unique number, for IPv4 support.
+        q = self.db.execute
+        for serial, in q("SELECT serial FROM subject_serial"
+                         " WHERE prefix IS NULL ORDER BY serial LIMIT 1"):
+            q("UPDATE subject_serial SET prefix=? WHERE serial=?",
+              (prefix, serial))
+            return serial
+        serial, = q("SELECT ifnull(max(serial)+1, 0)"
+                    " FROM subject_serial").next()
+        q("INSERT INTO subject_serial VALUES (?,?)", (serial, prefix))
+        return serial
+
+    def deleteCert(self, prefix):
+        q = self.db.execute
+        q("UPDATE cert SET email=null, cert=null, serial=null, not_after=null"
+          " WHERE prefix=?", (prefix,))
+        q("UPDATE subject_serial SET prefix=null WHERE prefix=?", (prefix,))
+        self.prefix_pool.free(prefix)
 
     def createCertificate(self, client_prefix, subject, pubkey, not_after=None):
         cert = crypto.X509()
@@ -399,7 +774,7 @@ class RegistryServer(object):
         else:
             cert.gmtime_adj_notAfter(self.cert_duration)
         cert.set_issuer(self.cert.ca.get_subject())
-        subject.CN = "%u/%u" % (int(client_prefix, 2), len(client_prefix))
+        subject.CN = client_prefix.cn
         cert.set_subject(subject)
         cert.set_pubkey(pubkey)
         # Certificate serial, for revocation support. Contrary to
@@ -408,10 +783,12 @@ class RegistryServer(object):
         self.setConfig('serial', serial)
         cert.set_serial_number(serial)
         cert.sign(self.cert.key, 'sha512')
+        not_after = x509.notAfter(cert)
         cert = crypto.dump_certificate(crypto.FILETYPE_PEM, cert)
-        self.db.execute("UPDATE cert SET cert = ? WHERE prefix = ?",
-                        (cert, client_prefix))
-        self.timeout = 1
+        self.db.execute("UPDATE cert SET cert=?, serial=?, not_after=?"
+                        " WHERE prefix=?",
+                        (cert, serial, not_after, client_prefix))
+        self.scheduleTimeout(not_after + GRACE_PERIOD)
         return cert
 
     @rpc
@@ -427,7 +804,7 @@ class RegistryServer(object):
                     not_after = cert.get_notAfter()
                 else:
                     return pem
-                return self.createCertificate(cn,
+                return self.createCertificate(utils.Prefix.fromStr(cn),
                     cert.get_subject(), cert.get_pubkey(), not_after)
 
     @rpc
@@ -443,21 +820,63 @@ class RegistryServer(object):
     def getNetworkConfig(self, cn):
         return self.network_config
 
+    @rpc
+    def getNetworkConfigDelta(self, cn, version, crl):
+        """Same as getNetworkConfig, but only what changed since given versions
+
+        Nothing is returned if the node has the current network version.
+        Else, if the config of the given network version is known, only
+        the parameters that changed are sent, and '-' is the list of removed
+        ones. Instead of the list of revoked serials, there's 'crl_delta'
+        with the changes since the given version of the CRL, as 2 lists:
+        revoked and removed serials. If changes are not known, the full
+        config or CRL is sent.
+        """
+        crl = int(crl)
+        with self.lock:
+            if version == self.version:
+                return
+            kw, full, cache = self._network_config_delta
+            # Unknown versions are mapped to None so that the cache can't
+            # have more keys than known versions of config and CRL.
+            old = self._config_history.get(version)
+            if old is None:
+                version = None
+            last = kw['crl_version']
+            if crl != last and not self.getConfig('crl_first') <= crl < last:
+                crl = None
+            try:
+                return cache[version, crl]
+            except KeyError:
+                pass
+            if old is None:
+                r = kw.copy()
+            else:
+                r = dict((k, v) for k, v in kw.iteritems() if old.get(k) != v)
+                r['-'] = [k for k in old if k not in kw]
+                r[''] = kw['']
+            if crl is None:
+                r['crl'] = full
+            elif crl != last:
+                r['crl_delta'] = revoked, removed = [], []
+                for serial, x in self.db.execute(
+                        "SELECT serial, revoked FROM crl_delta"
+                        " WHERE version > ? ORDER BY version", (crl,)):
+                    (revoked if x else removed).append(serial)
+            cache[version, crl] = r = zlib.compress(json.dumps(r))
+            return r
+
     @rpc
     def getBootstrapPeer(self, cn):
         with self.peers_lock:
             age, peers = self.peers
             if age < time.time() or not peers:
-                self.request_dump()
-                peers = [prefix
-                    for neigh_routes in self.ctl.neighbours.itervalues()
-                    for prefix in neigh_routes[1]
-                    if prefix]
+                peers = list(self.getPeers())
                 peers.append(self.prefix)
                 random.shuffle(peers)
                 self.peers = time.time() + 60, peers
             peer = peers.pop()
-            if peer == cn:
+            if str(peer) == cn:
                 # Very unlikely (e.g. peer restarted with empty cache),
                 # so don't bother looping over above code
                 # (in case 'peers' is empty).
@@ -474,8 +893,8 @@ class RegistryServer(object):
                     break
                 timeout = max(0, end - time.time())
             else:
-                logging.info("Timeout while querying address for %s/%s",
-                             int(peer, 2), len(peer))
+                logging.info("Timeout while querying address for %s",
+                             peer.cn)
                 return
             cert = self.getCert(cn)
         msg = "%s %s" % (peer, msg)
@@ -485,34 +904,27 @@ class RegistryServer(object):
     @rpc
     def revoke(self, cn_or_serial):
         with self.lock:
-          with self.db:
+          with self.prefix_pool, self.db:
             q = self.db.execute
             try:
                 serial = int(cn_or_serial)
             except ValueError:
                 prefix = utils.binFromSubnet(cn_or_serial)
-                cert = self.getCert(prefix)
-                q("UPDATE cert SET email=null, cert=null WHERE prefix=?",
-                  (prefix,))
-                cert = crypto.load_certificate(crypto.FILETYPE_PEM, cert)
-                serial = cert.get_serial_number()
-                self.sessions.pop(prefix, None)
+                serial, not_after = q("SELECT serial, not_after FROM cert"
+                    " WHERE prefix=? AND serial IS NOT NULL", (prefix,)).next()
+                self.deleteCert(prefix)
+                self.sessions.remove(str(prefix))
             else:
-                cert, = (cert for cert, prefix, email in self.iterCert()
-                              if cert.get_serial_number() == serial)
-            not_after = x509.notAfter(cert)
+                not_after, = q("SELECT not_after FROM cert WHERE serial=?",
+                               (serial,)).next()
             if time.time() < not_after:
                 q("INSERT INTO crl VALUES (?,?)", (serial, not_after))
-                self.updateNetworkConfig()
+                self.updateCrl((serial,))
+                self.scheduleTimeout(not_after)
 
     @rpc
     def versions(self):
-        with self.peers_lock:
-            self.request_dump()
-            peers = set(prefix
-                for neigh_routes in self.ctl.neighbours.itervalues()
-                for prefix in neigh_routes[1]
-                if prefix)
+        peers = set(self.getPeers())
         peers.add(self.prefix)
         peer_dict = {}
         s = self.sock,
@@ -529,12 +941,11 @@ class RegistryServer(object):
                     self.sendto(prefix, 4)
                 elif not r:
                     break
-        return json.dumps(peer_dict)
+        return json.dumps(dict((str(k), v) for k, v in peer_dict.iteritems()))
 
     @rpc
     def topology(self):
-        p = lambda p: '%s/%s' % (int(p, 2), len(p))
-        peers = deque((p(self.prefix),))
+        peers = deque((self.prefix.cn,))
         graph = defaultdict(set)
         s = self.sock,
         with self.lock:
@@ -543,7 +954,7 @@ class RegistryServer(object):
                 if r:
                     prefix, x = self.recv(5)
                     if prefix and x:
-                        prefix = p(prefix)
+                        prefix = prefix.cn
                         x = x.split()
                         try:
                             n = int(x.pop(0))
@@ -583,8 +994,11 @@ class RegistryClient(object):
             kw = getcallargs(*args, **kw)
             query = '/' + name
             if kw:
-                if any(type(v) is not str for v in kw.itervalues()):
-                    raise TypeError
+                for k, v in kw.iteritems():
+                    if type(v) is utils.Prefix:
+                        kw[k] = str(v)
+                    elif type(v) is not str:
+                        raise TypeError
                 query += '?' + urlencode(kw)
             url = self._path + query
             client_prefix = kw.get('cn')
@@ -0,0 +1,62 @@
+import shutil, tempfile, time, unittest
+from re6st import tunnel, utils
+
+class DummySocket(object):
+
+    def __init__(self, *args):
+        pass
+
+    def bind(self, address):
+        pass
+
+class DummyLoop(object):
+
+    def __init__(self):
+        self.timers = []
+
+    def addReader(self, *args):
+        pass
+
+    def at(self, when, callback):
+        self.timers.append((when, callback))
+
+class DummyCert(object):
+    network = utils.Prefix.fromStr('0' * 16)
+    prefix = utils.Prefix.fromStr('1' * 16)
+
+class DummyCache(object):
+    crl = ()
+    version = ''
+
+class TestBaseTunnelManager(unittest.TestCase):
+
+    def setUp(self):
+        self.run = tempfile.mkdtemp()
+        self._patch = tunnel.socket.socket, tunnel.RoutingCacheMonitor
+        tunnel.socket.socket = DummySocket
+        tunnel.RoutingCacheMonitor = lambda *args: None
+
+    def tearDown(self):
+        tunnel.socket.socket, tunnel.RoutingCacheMonitor = self._patch
+        shutil.rmtree(self.run)
+
+    def newManager(self, next_renew):
+        cache = DummyCache()
+        cache.next_renew = next_renew
+        loop = DummyLoop()
+        return loop, tunnel.BaseTunnelManager(
+            loop, self.run, cache, DummyCert())
+
+    def test_renew_timer(self):
+        next_renew = time.time() + 3600
+        loop, m = self.newManager(next_renew)
+        self.assertEqual(loop.timers, [(next_renew, m.invalidatePeers)])
+        m.invalidatePeers()
+        self.assertEqual(loop.timers[-1], (next_renew, m.invalidatePeers))
+
+    def test_renew_restart(self):
+        loop, m = self.newManager(time.time() - 1)
+        self.assertRaises(utils.ReexecException, m.invalidatePeers)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+import os, socket, time, unittest
+from re6st import utils
+
+class TestEventLoop(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = utils.EventLoop()
+        self.fds = []
+
+    def tearDown(self):
+        for fd in self.fds:
+            os.close(fd)
+        if self.loop._epoll:
+            self.loop._epoll.close()
+
+    def pipe(self, data=''):
+        r, w = os.pipe()
+        self.fds += r, w
+        if data:
+            os.write(w, data)
+        return r, w
+
+    def runOnce(self):
+        # never block if there's nothing to do
+        timer = self.loop.at(time.time(), lambda: None)
+        self.loop.runOnce()
+        timer.cancel()
+
+    def test_timer_order(self):
+        loop = self.loop
+        called = []
+        now = time.time()
+        for x in 3, 1, 2:
+            loop.at(now - x, lambda x=x: called.append(x))
+        loop.at(now - 2, lambda: called.append('2bis'))
+        later = loop.at(now + 3600, lambda: called.append('later'))
+        loop.runOnce()
+        self.assertEqual(called, [3, 2, '2bis', 1])
+        self.assertTrue(later.pending)
+        self.assertEqual(loop._nextTimeout(), later.when)
+
+    def test_timer_cancel(self):
+        loop = self.loop
+        called = []
+        now = time.time()
+        timer = loop.at(now - 1, lambda: called.append(1))
+        later = loop.at(now + 3600, lambda: called.append(2))
+        timer.cancel()
+        self.assertFalse(timer.pending)
+        self.assertEqual(loop._nextTimeout(), later.when)
+        self.assertEqual(len(loop._timers), 1)
+        later.cancel()
+        self.assertEqual(loop._nextTimeout(), None)
+        self.assertEqual(loop._timers, [])
+        self.assertEqual(called, [])
+
+    def test_timer_reschedule(self):
+        loop = self.loop
+        called = []
+        later = []
+        def callback():
+            # the timer is not pending anymore while its callback runs
+            self.assertFalse(timer.pending)
+            called.append(1)
+            loop.at(time.time() - 1, lambda: called.append(2))
+            later.append(loop.at(time.time() + 3600, callback))
+        timer = loop.at(time.time() - 1, callback)
+        loop.runOnce()
+        self.assertEqual(called, [1, 2])
+        later, = later
+        self.assertTrue(later.pending)
+        self.assertEqual(loop._nextTimeout(), later.when)
+
+    def test_infinite_timeout(self):
+        called = []
+        r, w = self.pipe('x')
+        self.loop.at(float('inf'), lambda: called.append(0))
+        self.loop.addReader(r, lambda: called.append(r))
+        self.loop.runOnce()
+        self.assertEqual(called, [r])
+
+    def test_reader_writer(self):
+        loop = self.loop
+        called = []
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        loop.addReader(a, lambda: called.append('r'))
+        loop.addWriter(a, lambda: called.append('w'))
+        self.runOnce()
+        self.assertEqual(called, ['w'])
+        b.send('x')
+        self.runOnce()
+        self.assertEqual(called, ['w', 'r', 'w'])
+        del called[:]
+        loop.removeWriter(a)
+        self.runOnce()
+        self.assertEqual(called, ['r'])
+        del called[:]
+        loop.removeReader(a)
+        loop.removeReader(a)
+        self.runOnce()
+        self.assertEqual(called, [])
+        self.assertEqual(loop._readers, {})
+        self.assertEqual(loop._writers, {})
+
+    def test_remove_during_dispatch(self):
+        loop = self.loop
+        called = []
+        r1, _ = self.pipe('x')
+        r2, w2 = self.pipe('x')
+        def reader(fd, other):
+            called.append(fd)
+            loop.removeReader(other)
+            loop.removeWriter(w2)
+        loop.addReader(r1, lambda: reader(r1, r2))
+        loop.addReader(r2, lambda: reader(r2, r1))
+        loop.addWriter(w2, lambda: called.append(w2))
+        self.runOnce()
+        self.assertEqual(len(called), 1)
+        self.assertIn(called[0], (r1, r2))
+        self.assertEqual(loop._writers, {})
+        del called[:]
+        self.runOnce()
+        self.assertEqual(len(called), 1)
+
+class TestEventLoopSelect(TestEventLoop):
+
+    def setUp(self):
+        TestEventLoop.setUp(self)
+        if self.loop._epoll:
+            self.loop._epoll.close()
+            self.loop._epoll = None
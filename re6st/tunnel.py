@@ -1,47 +1,358 @@
-import errno, logging, os, random, socket, subprocess, struct, time, weakref
-from collections import defaultdict, deque
-from bisect import bisect, insort
+import errno, fcntl, logging, os, random, socket, subprocess, struct, time
+import weakref
+from collections import defaultdict
+from heapq import heapify, heappop, heappush
 from OpenSSL import crypto
-from . import ctl, plib, utils, version, x509
+from . import ctl, netlink, plib, utils, version, x509
 
 PORT = 326
 
+TUNSETIFF = 0x400454ca
+TUNSETPERSIST = 0x400454cb
+IFF_TAP = 0x0002
+IFF_NO_PI = 0x1000
+
+def tuntap(iface, persist):
+    """Create a persistent tap interface, or delete it if persist is false"""
+    fd = os.open('/dev/net/tun', os.O_RDWR)
+    try:
+        fcntl.ioctl(fd, TUNSETIFF, struct.pack('16sH22x', iface,
+                                                 IFF_TAP | IFF_NO_PI))
+        fcntl.ioctl(fd, TUNSETPERSIST, int(persist))
+    finally:
+        os.close(fd)
+
 
 class MultiGatewayManager(dict):
 
     def __init__(self, gateway):
         self._gw = gateway
+        self._rtnl = netlink.Netlink(blocking=True)
+
+    @staticmethod
+    def _route(add, dest, gw):
+        logging.trace('route %s %s/32 via %s', 'add' if add else 'del',
+                      dest, gw)
+        return netlink.route(add, socket.AF_INET, socket.inet_aton(dest), 32,
+                             socket.inet_aton(gw))
+
+    def add(self, dest_list, route):
+        msg = []
+        for dest in dest_list:
+            try:
+                self[dest][1] += 1
+            except KeyError:
+                gw = self._gw(dest) if route else None
+                self[dest] = [gw, 0]
+                if gw:
+                    msg.append(self._route(True, dest, gw))
+        if msg:
+            self._rtnl.check_call(*msg)
+
+    def remove(self, dest_list):
+        msg = []
+        for dest in dest_list:
+            gw, count = self[dest]
+            if count:
+                self[dest][1] = count - 1
+            else:
+                del self[dest]
+                if gw:
+                    msg.append(self._route(False, dest, gw))
+        if msg:
+            self._rtnl.call(*msg)
+
+class PrefixDict(dict):
+    """Dict indexed by prefix, with longest-prefix match
+
+    A lookup costs 1 dict access per distinct prefix length, which is
+    usually small in a re6st network.
+    """
+
+    def __init__(self):
+        self._length_dict = defaultdict(int)
+        self._length_list = []  # in decreasing order
+
+    def __setitem__(self, prefix, value):
+        if prefix not in self:
+            n = len(prefix)
+            if not self._length_dict[n]:
+                self._length_list.append(n)
+                self._length_list.sort(reverse=True)
+            self._length_dict[n] += 1
+        dict.__setitem__(self, prefix, value)
+
+    def __delitem__(self, prefix):
+        dict.__delitem__(self, prefix)
+        n = len(prefix)
+        self._length_dict[n] -= 1
+        if not self._length_dict[n]:
+            del self._length_dict[n]
+            self._length_list.remove(n)
+
+    def pop(self, prefix, *default):
+        if prefix in self:
+            value = self[prefix]
+            del self[prefix]
+            return value
+        return dict.pop(self, prefix, *default)
+
+    def lookup(self, prefix):
+        for n in self._length_list:
+            try:
+                return self[prefix[:n]]
+            except KeyError:
+                pass
+
+
+class PeerDict(PrefixDict):
+    """Peers indexed by prefix
+
+    Certificate expiration dates are kept in a heap so that expired peers
+    can be removed in bulk.
+    """
 
-    def _route(self, cmd, dest, gw):
-        if gw:
-            cmd = 'ip', '-4', 'route', cmd, '%s/32' % dest, 'via', gw
-            logging.trace('%r', cmd)
-            subprocess.check_call(cmd)
+    # Number of expired peers above which the heap is rebuilt.
+    bulk_expire = 64
 
-    def add(self, dest, route):
+    def __init__(self):
+        PrefixDict.__init__(self)
+        self._stop_dates = []
+
+    def add(self, peer):
+        self[peer.prefix] = peer
+
+    def remove(self, prefix):
+        del self[prefix]
+
+    def setStopDate(self, peer, stop_date):
+        if peer.stop_date != stop_date:
+            peer.stop_date = stop_date
+            heappush(self._stop_dates, (stop_date, peer.prefix))
+
+    def expire(self, now):
+        """Remove peers with expired certificates
+
+        Return them, with the next expiration date.
+        """
+        expired = []
+        removed = defaultdict(int)
+        stop_dates = self._stop_dates
+        get = self.get
+        while stop_dates:
+            stop_date, prefix = stop_dates[0]
+            peer = get(prefix)
+            if peer is None or peer.stop_date != stop_date:
+                heappop(stop_dates) # outdated entry
+                continue
+            if stop_date >= now:
+                break
+            if len(expired) == self.bulk_expire:
+                # Many peers expire at once (e.g. the network was offline):
+                # rather than popping entries one by one, split the heap
+                # in a single pass, dropping outdated entries.
+                keep = []
+                for x in stop_dates:
+                    stop_date, prefix = x
+                    peer = get(prefix)
+                    if peer is None or peer.stop_date != stop_date:
+                        continue # outdated entry
+                    if stop_date < now:
+                        dict.__delitem__(self, prefix)
+                        removed[prefix[1]] += 1
+                        expired.append(peer)
+                    else:
+                        keep.append(x)
+                heapify(keep)
+                self._stop_dates = stop_dates = keep
+                break
+            heappop(stop_dates)
+            dict.__delitem__(self, prefix)
+            removed[prefix[1]] += 1
+            expired.append(peer)
+        if removed:
+            length_dict = self._length_dict
+            for n, count in removed.iteritems():
+                length_dict[n] -= count
+                if not length_dict[n]:
+                    del length_dict[n]
+            self._length_list = sorted(length_dict, reverse=True)
+        return expired, stop_dates[0][0] if stop_dates else float('inf')
+
+
+class RoutingCacheMonitor(object):
+    """Check that routes in cache match the routing table
+
+    WRKD: There were changes in Linux 4.2 to not cache routes uselessly
+          and the bug may have been fixed at the same time. At least,
+          it happens less often than with previous versions.
+          babeld has a distinct issue (no atomic update of route) that
+          increases the probability of invalid entries in the cache:
+           https://lists.alioth.debian.org/pipermail/babel-users/2016-June/002547.html
+
+    Routes under the re6st network are followed incrementally with rtnetlink
+    notifications. Cached routes are checked when they are notified, and
+    when a route changes, by dumping the cache once to check only entries
+    that are new or affected by the change. Invalid entries are flushed
+    individually.
+    """
+
+    _timer = None
+
+    def __init__(self, loop, network, report):
+        self._loop = loop
+        self._network = network
+        self._report = report
+        self._open()
+        self._resync()
+
+    def _open(self):
+        self._nl = netlink.Netlink(netlink.RTMGRP_IPV6_ROUTE)
+        self._loop.addReader(self._nl, self._recv)
+
+    def close(self):
+        if self._timer:
+            self._timer.cancel()
+        self._loop.removeReader(self._nl)
+        self._nl.close()
+
+    def _resync(self):
+        if self._timer:
+            self._timer.cancel()
+        self._routes = PrefixDict() # uncached routes
+        self._cached = {}
+        self._changed = set()
+        self._checking = self._dump = self._timer = None
+        self._dump_list = [0, netlink.RTM_F_CLONED]
+        self._nextDump()
+
+    def _nextDump(self):
         try:
-            self[dest][1] += 1
-        except KeyError:
-            gw = self._gw(dest) if route else None
-            self[dest] = [gw, 0]
-            self._route('add', dest, gw)
-
-    def remove(self, dest):
-        gw, count = self[dest]
-        if count:
-            self[dest][1] = count - 1
+            flags = self._dump_list.pop(0)
+        except IndexError:
+            self._dump = None
+            return
+        self._dump = self._nl.send(netlink.RTM_GETROUTE, netlink.NLM_F_DUMP,
+            netlink.packRoute(socket.AF_INET6, 0, flags))
+        self._dump_flags = flags
+        self._dump_cached = {}
+
+    def _scheduleCheck(self):
+        if not (self._timer and self._timer.pending):
+            # Let babeld finish to update its routes.
+            self._timer = self._loop.at(time.time() + 1, self._check)
+
+    def _check(self):
+        if self._dump:
+            self._scheduleCheck()
         else:
-            del self[dest]
-            try:
-                self._route('del', dest, gw)
-            except:
-                pass
+            # The previous check may not be finished if a dump failed.
+            if self._checking is None:
+                self._checking = self._changed
+            else:
+                self._checking |= self._changed
+            self._changed = set()
+            if netlink.RTM_F_CLONED not in self._dump_list:
+                self._dump_list.append(netlink.RTM_F_CLONED)
+            self._nextDump()
+
+    def _recv(self):
+        try:
+            msg_list = self._nl.recv()
+        except socket.error, e:
+            if e.errno != errno.ENOBUFS:
+                raise
+            logging.info("Lost rtnetlink notifications. Resync routes.")
+            # Start over with a new socket, because a dump may be running
+            # and its remaining messages could not be told apart from
+            # notifications, and the kernel would refuse another dump on
+            # this socket (EBUSY) until it is finished.
+            self.close()
+            self._open()
+            self._resync()
+            return
+        for type, flags, seq, data in msg_list:
+            if type == netlink.NLMSG_DONE:
+                if seq == self._dump:
+                    self._dumped()
+            elif type == netlink.NLMSG_ERROR:
+                if data:
+                    logging.error("rtnetlink: %s", os.strerror(data))
+                    if seq == self._dump:
+                        # Retry later.
+                        del self._dump_cached
+                        self._dump_list.insert(0, self._dump_flags)
+                        self._dump = None
+                        self._scheduleCheck()
+            elif type in (netlink.RTM_NEWROUTE, netlink.RTM_DELROUTE):
+                self._update(type == netlink.RTM_NEWROUTE,
+                    netlink.unpackRoute(data), seq and seq == self._dump)
+
+    def _update(self, new, route, dumped):
+        if route.family != socket.AF_INET6 or route.type == netlink.RTN_LOCAL:
+            return
+        attrs = route.attrs
+        dst = utils.binFromRawIp(attrs.get(netlink.RTA_DST, '\0' * 16))
+        n = self._network
+        if not dst.startswith(n):
+            return
+        dst = dst[len(n):route.dst_len]
+        via = attrs.get(netlink.RTA_GATEWAY), attrs.get(netlink.RTA_OIF)
+        if route.flags & netlink.RTM_F_CLONED:
+            if dumped:
+                self._dump_cached[dst] = via, route
+            elif new:
+                if self._cached.get(dst) != via:
+                    self._cached[dst] = via
+                    self._checkCached(dst, via, route)
+            else:
+                self._cached.pop(dst, None)
+        elif (via if new else None) != self._routes.get(dst):
+            if new:
+                self._routes[dst] = via
+            else:
+                del self._routes[dst]
+            if not dumped:
+                self._changed.add(dst)
+                self._scheduleCheck()
+
+    def _dumped(self):
+        cached = self._dump_cached
+        del self._dump_cached
+        if cached or self._checking is not None:
+            checking = self._checking or ()
+            old = self._cached
+            self._cached = {}
+            for dst, (via, route) in cached.iteritems():
+                self._cached[dst] = via
+                if old.get(dst) != via or any(dst.startswith(x)
+                                              for x in checking):
+                    self._checkCached(dst, via, route)
+            self._checking = None
+        self._nextDump()
+
+    def _checkCached(self, dst, via, route):
+        expected = self._routes.lookup(dst)
+        if expected is None or expected == via:
+            return
+        msg = "Invalid route in cache for " + utils.ipFromBin(
+            self._network + dst)
+        logging.error("%s. Flushing...", msg)
+        self._cached.pop(dst, None)
+        self._nl.send(netlink.RTM_DELROUTE, netlink.NLM_F_ACK,
+            netlink.packRoute(socket.AF_INET6, route.dst_len,
+                netlink.RTM_F_CLONED, ((k, v) for k, v in route.attrs.iteritems()
+                    if k in (netlink.RTA_DST, netlink.RTA_GATEWAY,
+                             netlink.RTA_OIF, netlink.RTA_TABLE)),
+                route.table))
+        self._report(msg)
+
 
 class Connection(object):
 
     _retry = 0
+    _external_ip = _management = None
     serial = None
-    time = float('inf')
 
     def __init__(self, tunnel_manager, address_list, iface, prefix):
         self.tunnel_manager = tunnel_manager
@@ -62,19 +373,32 @@ class Connection(object):
 
     def open(self):
         tm = self.tunnel_manager
-        self.time = time.time()
+        self._management = m = plib.Management(
+            os.path.join(tm.run, self.iface + '.sock'), tm._loop,
+            self._handleManagementEvent, 'echo on all', 'state on')
         self.process = plib.client(
             self.iface, (self.address_list[self._retry],), tm.encrypt,
-            '--tls-remote', '%u/%u' % (int(self._prefix, 2), len(self._prefix)),
+            '--tls-remote', self._prefix.cn,
             '--resolv-retry', '0',
             '--connect-retry-max', '3', '--tls-exit',
             '--remap-usr1', 'SIGTERM',
             '--ping-exit', str(tm.timeout),
-            '--route-up', '%s %u' % (plib.ovpn_client, tm.write_sock.fileno()),
-            *tm.ovpn_args)
+            # BBB: for servers that only push setenv-safe external_ip
+            '--route-up', '%s %u' % (plib.ovpn_client,
+                                     tm.write_sock.fileno()),
+            *m.args + tuple(tm.ovpn_args))
         tm.resetTunnelRefresh()
         self._retry += 1
 
+    def _handleManagementEvent(self, management, event, args):
+        if event == 'ECHO':
+            # pushed by the server (see BaseTunnelManager.handleServerEvent)
+            x = args.split(',', 1)[-1].split()
+            if len(x) == 2 and x[0] == 'external_ip':
+                self._external_ip = x[1]
+        elif event == 'STATE' and args.split(',', 2)[1:2] == ['CONNECTED']:
+            self.tunnel_manager.handleClientEvent(self, self._external_ip)
+
     def connected(self, serial):
         cache = self.tunnel_manager.cache
         if serial in cache.crl:
@@ -93,13 +417,15 @@ class Connection(object):
             self.process.stop()
         except AttributeError:
             pass
+        if self._management:
+            self._management.close()
+            self._management = None
 
     def refresh(self):
         # Check that the connection is alive
         if self.process.poll() is not None:
-            logging.info('Connection with %s/%s has failed with return code %s',
-                         int(self._prefix, 2), len(self._prefix),
-                         self.process.returncode)
+            logging.info('Connection with %s has failed with return code %s',
+                         self._prefix.cn, self.process.returncode)
             if self._retry is None:
                 return 1
             if len(self.address_list) <= self._retry:
@@ -173,7 +499,9 @@ class BaseTunnelManager(object):
 
     _forward = None
 
-    def __init__(self, cache, cert, address=()):
+    def __init__(self, loop, run, cache, cert, address=()):
+        self._loop = loop
+        self.run = run
         self.cert = cert
         self._network = cert.network
         self._prefix = cert.prefix
@@ -181,7 +509,12 @@ class BaseTunnelManager(object):
         self._connecting = set()
         self._connection_dict = {}
         self._served = defaultdict(dict)
+        self._servers = {}
         self._version = cache.version
+        # Revoked serials, for OpenVPN --crl-verify in 'dir' mode.
+        self.crl_dir = os.path.join(run, 'crl')
+        utils.makedirs(self.crl_dir)
+        self._updateCrl()
 
         address_dict = defaultdict(list)
         for family, address in address:
@@ -194,64 +527,51 @@ class BaseTunnelManager(object):
         # See also http://stackoverflow.com/questions/597225/
         # about binding and anycast.
         self.sock.bind(('::', PORT))
+        loop.addReader(self.sock, self.handlePeerEvent)
 
         p = x509.Peer(self._prefix)
-        p.stop_date = cache.next_renew
-        self._peers = [p]
-        self._timeouts = [(p.stop_date, self.invalidatePeers)]
-
-        # Only to check routing cache. Should go back to
-        # TunnelManager when we don't need to check it anymore.
-        self._next_refresh = time.time()
-
-    def select(self, r, w, t):
-        r[self.sock] = self.handlePeerEvent
-        t += self._timeouts
-        if self._next_refresh: # same comment as in __init__
-            t.append((self._next_refresh, self.refresh))
-
-    def refresh(self):
-        self._next_refresh = time.time() + 5
-        self.checkRoutingCache()
+        self._peers = PeerDict()
+        self._peers.add(p)
+        self._peers.setStopDate(p, cache.next_renew)
+        self._timeouts = {}
+        self.selectTimeout(p.stop_date, self.invalidatePeers)
+        self._routing_cache = RoutingCacheMonitor(loop, self._network,
+                                                  self._reportInvalidRoute)
 
     def selectTimeout(self, next, callback, force=True):
-        t = self._timeouts
-        for i, x in enumerate(t):
-            if x[1] == callback:
-                if not next:
-                    logging.debug("timeout: removing %r (%s)", callback.__name__, next)
-                    del t[i]
-                elif force or next < x[0]:
-                    logging.debug("timeout: updating %r (%s)", callback.__name__, next)
-                    t[i] = next, callback
+        t = self._timeouts.get(callback)
+        if t is not None and t.pending:
+            if not next:
+                logging.debug("timeout: removing %r (%s)", callback.__name__, next)
+                t.cancel()
+                del self._timeouts[callback]
+                return
+            if not (force or next < t.when):
                 return
-        logging.debug("timeout: adding %r (%s)", callback.__name__, next)
-        t.append((next, callback))
+            logging.debug("timeout: updating %r (%s)", callback.__name__, next)
+            t.cancel()
+        elif not next:
+            return
+        else:
+            logging.debug("timeout: adding %r (%s)", callback.__name__, next)
+        self._timeouts[callback] = self._loop.at(next, callback)
 
     def invalidatePeers(self):
-        next = float('inf')
-        now = time.time()
-        remove = []
-        for i, peer in enumerate(self._peers):
-            if peer.stop_date < now:
-                if peer.prefix == self._prefix:
-                    raise utils.ReexecException("Restart to renew certificate")
-                remove.append(i)
-            elif peer.stop_date < next:
-                next = peer.stop_date
-        for i in reversed(remove):
-            del self._peers[i]
+        expired, next = self._peers.expire(time.time())
+        for peer in expired:
+            if peer.prefix == self._prefix:
+                raise utils.ReexecException("Restart to renew certificate")
         self.selectTimeout(next, self.invalidatePeers)
 
     def _getPeer(self, prefix):
-        return self._peers[bisect(self._peers, prefix) - 1]
+        return self._peers.lookup(prefix) or x509.Peer(prefix)
 
     def sendto(self, prefix, msg):
         to = utils.ipFromBin(self._network + prefix), PORT
-        peer = self._getPeer(prefix)
-        if peer.prefix != prefix:
+        peer = self._peers.get(prefix)
+        if peer is None:
             peer = x509.Peer(prefix)
-            insort(self._peers, peer)
+            self._peers.add(peer)
         elif peer.connected:
             if msg is None:
                 return
@@ -277,7 +597,7 @@ class BaseTunnelManager(object):
         if address[0] == '::1':
             try:
                 prefix, msg = msg.split('\0', 1)
-                int(prefix, 2)
+                prefix = utils.Prefix.fromStr(prefix)
             except ValueError:
                 return
             if msg:
@@ -308,7 +628,7 @@ class BaseTunnelManager(object):
                     peer.verify(msg[i:], h)
                     peer.newSession(self.cert.decrypt(h))
                 except (AttributeError, crypto.Error, x509.NewSessionError,
-                        subprocess.CalledProcessError):
+                        subprocess.CalledProcessError, ValueError):
                     logging.debug('ignored new session key from %r',
                                   address, exc_info=1)
                     return
@@ -320,27 +640,23 @@ class BaseTunnelManager(object):
                 seqno = msg.startswith(h)
                 msg = msg[len(h):]
             try:
-                cert = self.cert.loadVerify(msg,
-                    True, crypto.FILETYPE_ASN1)
-                stop_date = x509.notAfter(cert)
-                serial = cert.get_serial_number()
+                cert, serial, stop_date, p = self.cert.loadVerifyPeer(msg)
                 if serial in self.cache.crl:
                     raise ValueError("revoked")
             except (x509.VerifyError, ValueError), e:
                 logging.debug('ignored invalid certificate from %r (%s)',
                               address, e.args[-1])
                 return
-            p = utils.binFromSubnet(x509.subnetFromCert(cert))
             if p != peer.prefix:
                 if not prefix.startswith(p):
-                    logging.debug('received %s/%s cert from wrong source %r',
-                                  int(p, 2), len(p), address)
+                    logging.debug('received %s cert from wrong source %r',
+                                  p.cn, address)
                     return
-                peer = x509.Peer(p)
-                insort(self._peers, peer)
+                peer = self._peers.get(p) or x509.Peer(p)
+            self._peers.add(peer)
             peer.cert = cert
             peer.serial = serial
-            peer.stop_date = stop_date
+            self._peers.setStopDate(peer, stop_date)
             self.selectTimeout(stop_date, self.invalidatePeers, False)
             if seqno:
                 self._sendto(to, peer.hello(self.cert))
@@ -386,8 +702,11 @@ class BaseTunnelManager(object):
                     self._version = msg
                     self.selectTimeout(time.time() + 1, self.newVersion)
                 finally:
-                    if peer:
-                        self._getPeer(peer).version = self._version
+                    # The peer is unknown if it was not seen since
+                    # its expiration.
+                    p = self._peers.get(peer)
+                    if p is not None:
+                        p.version = self._version
             else:
                 self.selectTimeout(time.time() + 1, self.newVersion)
         elif code <= 3: # kill
@@ -409,13 +728,13 @@ class BaseTunnelManager(object):
             # the registry wants to know the topology for debugging purpose
             if not peer or peer == self.cache.registry_prefix:
                 return str(len(self._connection_dict)) + ''.join(
-                    ' %s/%s' % (int(x, 2), len(x))
+                    ' ' + x.cn
                     for x in (self._connection_dict, self._served)
                     for x in x)
         elif code == 7:
             # XXX: Quick'n dirty way to log in a common place.
             if peer and self._prefix == self.cache.registry_prefix:
-                logging.info("%s/%s: %s", int(peer, 2), len(peer), msg)
+                logging.info("%s: %s", peer.cn, msg)
 
     @staticmethod
     def _restart():
@@ -437,38 +756,101 @@ class BaseTunnelManager(object):
         self._newVersion()
         self.cache.warnProtocol()
         crl = self.cache.crl
-        for i in reversed([i for i, peer in enumerate(self._peers)
-                             if peer.serial in crl]):
-            del self._peers[i]
+        self.cert.purgeVerified(crl)
+        for peer in [peer for peer in self._peers.itervalues()
+                          if peer.serial in crl]:
+            self._peers.remove(peer.prefix)
         if self.cert.cert.get_serial_number() in crl:
             raise utils.ReexecException("Our certificate has just been revoked."
                 " Let's try to renew it.")
+        self._updateCrl()
+        for served in self._served.itervalues():
+            for iface, (serial, cid) in served.iteritems():
+                if serial in crl:
+                    self._servers[iface].send('client-kill ' + cid)
         if (not self.NEED_RESTART.isdisjoint(changed)
-            or version.protocol < self.cache.min_protocol
-            # TODO: With --management, we could kill clients without restarting.
-            or not all(crl.isdisjoint(serials.itervalues())
-                       for serials in self._served.itervalues())):
+            or version.protocol < self.cache.min_protocol):
             # Wait at least 1 second to broadcast new version to neighbours.
             # If re6stnet is too old, don't abort now, because a new version
             # may have been installed without restart.
             self.selectTimeout(time.time() + 1 + self.cache.delay_restart,
                                self._restart)
 
-    def handleServerEvent(self, sock):
-        event, args = eval(sock.recv(65536))
+    def _updateCrl(self):
+        crl = self.cache.crl
+        old = set()
+        for x in os.listdir(self.crl_dir):
+            if not x.isdigit(): # not ours
+                continue
+            serial = int(x)
+            if serial in crl:
+                old.add(serial)
+            else:
+                os.remove(os.path.join(self.crl_dir, x))
+        for serial in crl:
+            if serial not in old:
+                open(os.path.join(self.crl_dir, str(serial)), 'w').close()
+
+    def serverManagement(self, iface):
+        """Return the management interface for the OpenVPN server on iface"""
+        self._servers[iface] = m = plib.Management(
+            os.path.join(self.run, iface + '.sock'), self._loop,
+            self.handleServerEvent)
+        return m
+
+    def handleServerEvent(self, management, event, args, env=None):
+        if not event.startswith('CLIENT:'):
+            return
         logging.debug("%s%r", event, args)
-        r = getattr(self, '_ovpn_' + event.replace('-', '_'))(*args)
-        if r is not None:
-            sock.send(chr(r))
+        try:
+            common_name = env['common_name']
+            iface = env['dev']
+            serial = int(env['tls_serial_0'])
+            ip = (env.get('trusted_ip') or env.get('trusted_ip6') or
+                  env.get('untrusted_ip') or env['untrusted_ip6'])
+        except (KeyError, ValueError), e:
+            logging.error("%s: missing or invalid %s", event, e)
+            if event in ('CLIENT:CONNECT', 'CLIENT:REAUTH'):
+                # OpenVPN waits for an answer until --hand-window expires.
+                management.send('client-deny %s %s "invalid env"'
+                                % tuple(args[:2]))
+            return
+        if event == 'CLIENT:DISCONNECT':
+            self._ovpn_client_disconnect(common_name, iface, serial, ip)
+            return
+        cid, kid = args[:2]
+        if event == 'CLIENT:CONNECT':
+            ok = self._ovpn_client_connect(cid, common_name, iface, serial, ip)
+        elif event == 'CLIENT:REAUTH':
+            ok = serial not in self.cache.crl
+            if ok:
+                management.send('client-auth-nt %s %s' % (cid, kid))
+                return
+        else:
+            return
+        if ok:
+            # Send client its external ip address. BBB: setenv-safe is for
+            # nodes that still get it from a route-up script.
+            management.send('client-auth %s %s' % (cid, kid),
+                            'push "setenv-safe external_ip %s"' % ip,
+                            'push "echo external_ip %s"' % ip,
+                            'END')
+        else:
+            management.send('client-deny %s %s revoked' % (cid, kid))
+
+    def _reportInvalidRoute(self, msg):
+        self.sendto(self.cache.registry_prefix,
+                    '\7%s (%s)' % (msg, os.uname()[2]))
 
-    def _ovpn_client_connect(self, common_name, iface, serial, trusted_ip):
+    def _ovpn_client_connect(self, cid, common_name, iface, serial,
+                             trusted_ip):
         if serial in self.cache.crl:
             return False
         prefix = utils.binFromSubnet(common_name)
-        self._served[prefix][iface] = serial
+        self._served[prefix][iface] = serial, cid
         if isinstance(self, TunnelManager): # XXX
             if self._gateway_manager is not None:
-                self._gateway_manager.add(trusted_ip, False)
+                self._gateway_manager.add((trusted_ip,), False)
             if prefix in self._connection_dict and self._prefix < prefix:
                 self._kill(prefix)
                 self.cache.connecting(prefix, 0)
@@ -488,50 +870,7 @@ class BaseTunnelManager(object):
         if isinstance(self, TunnelManager): # XXX
             self._abortTunnelKiller(prefix, iface)
             if self._gateway_manager is not None:
-                self._gateway_manager.remove(trusted_ip)
-
-    def checkRoutingCache(self):
-        # WRKD: Check that routes in cache match the routing table.
-        #       There were changes in Linux 4.2 to not cache routes uselessly
-        #       and the bug may have been fixed at the same time. At least,
-        #       it happens less often than with previous versions.
-        #       babeld has a distinct issue (no atomic update of route) that
-        #       increases the probability of invalid entries in the cache:
-        #        https://lists.alioth.debian.org/pipermail/babel-users/2016-June/002547.html
-        with open('/proc/net/ipv6_route', "r", 4096) as f:
-            try:
-                routing_table = f.read()
-            except IOError, e:
-                # ???: If someone can explain why the kernel sometimes fails
-                #      even when there's a lot of free memory.
-                if e.errno != errno.ENOMEM:
-                    raise
-                logging.error("Ignoring ENOMEM when checking routing cache")
-                return
-        cache = []
-        other = []
-        n = self._network
-        a = len(n)
-        for line in routing_table.splitlines():
-            line = line.split()
-            dst = bin(int(line[0], 16))[2:].rjust(128, '0')
-            if dst.startswith(n):
-                flags = int(line[8], 16)
-                if not (flags & 0x80000000): # RTF_LOCAL
-                    (cache if flags & 0x1000000 # RTF_CACHE
-                     else other).append((dst[a:int(line[1], 16)], line[4]))
-        other.sort()
-        for dst, via in cache:
-            i = bisect(other, (dst,))
-            if i == len(other) or dst < other[i][0]:
-                i -= 1
-            if dst.startswith(other[i][0]) and via != other[i][1]:
-                msg = "Invalid route in cache for " + utils.ipFromBin(n + dst)
-                logging.error("%s. Flushing...", msg)
-                subprocess.call(("ip", "-6", "route", "flush", "cached"))
-                self.sendto(self.cache.registry_prefix,
-                    '\7%s (%s)' % (msg, os.uname()[2]))
-                break
+                self._gateway_manager.remove((trusted_ip,))
 
 
 class TunnelManager(BaseTunnelManager):
@@ -539,15 +878,17 @@ class TunnelManager(BaseTunnelManager):
     NEED_RESTART = BaseTunnelManager.NEED_RESTART.union((
         'client_count', 'max_clients', 'tunnel_refresh'))
 
-    def __init__(self, control_socket, cache, cert, openvpn_args,
+    def __init__(self, loop, control_socket, cache, cert, openvpn_args,
                  timeout, client_count, iface_list, address, ip_changed,
-                 remote_gateway, disable_proto, neighbour_list=()):
-        super(TunnelManager, self).__init__(cache, cert, address)
-        self.ctl = ctl.Babel(control_socket, weakref.proxy(self), self._network)
+                 remote_gateway, disable_proto, neighbour_list=(),
+                 babel_monitor=False):
+        # OpenVPN management sockets are created next to Babel's one.
+        super(TunnelManager, self).__init__(loop,
+            os.path.dirname(control_socket), cache, cert, address)
+        self.ctl = ctl.Babel(control_socket, weakref.proxy(self),
+                             self._network, loop, babel_monitor)
         self.ovpn_args = openvpn_args
         self.timeout = timeout
-        self._read_sock, self.write_sock = socket.socketpair(
-            socket.AF_UNIX, socket.SOCK_DGRAM)
         self._disconnected = 0
         self._distant_peers = []
         self._iface_to_prefix = {}
@@ -558,13 +899,32 @@ class TunnelManager(BaseTunnelManager):
         self._disable_proto = disable_proto
         self._neighbour_set = set(map(utils.binFromSubnet, neighbour_list))
         self._killing = {}
+        # BBB: see handleRouteUp
+        self._read_sock, self.write_sock = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_DGRAM)
+        loop.addReader(self._read_sock, self.handleRouteUp)
 
         self.resetTunnelRefresh()
+        self._next_refresh = loop.at(time.time(), self.refresh)
 
         self._client_count = client_count
-        self.new_iface_list = deque('re6stnet' + str(i)
-            for i in xrange(1, self._client_count + 1))
-        self._free_iface_list = []
+        self.tap_list = ['re6stnet' + str(i)
+            for i in xrange(1, self._client_count + 1)]
+        # Create all interfaces now so that it takes no time to get one
+        # when making a new tunnel.
+        t = time.time()
+        created = []
+        try:
+            for iface in self.tap_list:
+                tuntap(iface, True)
+                created.append(iface)
+        except:
+            for iface in created:
+                tuntap(iface, False)
+            raise
+        logging.info("%u tap interfaces created in %.3fs",
+                     len(self.tap_list), time.time() - t)
+        self._free_iface_list = self.tap_list[::-1]
 
     @property
     def encrypt(self):
@@ -573,32 +933,17 @@ class TunnelManager(BaseTunnelManager):
     def resetTunnelRefresh(self):
         self._next_tunnel_refresh = time.time() + self.cache.tunnel_refresh
 
-    def _tuntap(self, iface=None):
-        if iface:
-            self.new_iface_list.appendleft(iface)
-            action = '--rmtun'
-        else:
-            iface = self.new_iface_list.popleft()
-            action = '--mktun'
-        # BBB: do not use 'ip tuntap' which is not available on old dists
-        args = ('openvpn', action, '--verb', '0',
-                '--dev', iface, '--dev-type', 'tap')
-        logging.debug('%r', args)
-        subprocess.check_call(args)
-        return iface
-
     def delInterfaces(self):
-        iface_list = self._free_iface_list
-        iface_list += self._iface_to_prefix
+        del self._free_iface_list[:]
         self._iface_to_prefix.clear()
-        while iface_list:
-          self._tuntap(iface_list.pop())
+        t = time.time()
+        for iface in self.tap_list:
+            tuntap(iface, False)
+        logging.info("%u tap interfaces deleted in %.3fs",
+                     len(self.tap_list), time.time() - t)
 
     def _getFreeInterface(self, prefix):
-        try:
-            iface = self._free_iface_list.pop()
-        except IndexError:
-            iface = self._tuntap()
+        iface = self._free_iface_list.pop()
         self._iface_to_prefix[iface] = prefix
         return iface
 
@@ -606,51 +951,70 @@ class TunnelManager(BaseTunnelManager):
         self._free_iface_list.append(iface)
         del self._iface_to_prefix[iface]
 
-    def select(self, r, w, t):
-        super(TunnelManager, self).select(r, w, t)
-        r[self._read_sock] = self.handleClientEvent
-        self.ctl.select(r, w, t)
+    def _scheduleRefresh(self, delay=5):
+        self._next_refresh.cancel()
+        self._next_refresh = self._loop.at(time.time() + delay, self.refresh)
 
     def refresh(self):
         logging.debug('Checking tunnels...')
         if self._cleanDeads() or \
-           self._next_tunnel_refresh < time.time() or \
-           self._killing or \
-           self._makeNewTunnels(False):
-            self._next_refresh = None
-            self.ctl.request_dump() # calls babel_dump immediately at startup
+           self._next_tunnel_refresh < time.time():
+            sections = ctl.FULL
+        elif self._killing:
+            # Routes are only needed to make new tunnels, and by killers
+            # that don't know yet whether their neighbour is still used:
+            # tables of routes can be huge compared to those of neighbours.
+            sections = ctl.FULL if (
+                len(self._connection_dict) < self._client_count or
+                any(tunnel_killer.state in (None, 'softLocking')
+                    for tunnel_killer in self._killing.itervalues())
+                ) else ctl.INTERFACES | ctl.NEIGHBOURS
+        elif self._makeNewTunnels(False):
+            sections = ctl.FULL
         else:
-            self._next_refresh = time.time() + 5
-        self.checkRoutingCache()
+            return self._scheduleRefresh()
+        self._next_refresh.cancel()
+        # calls babel_dump immediately at startup
+        self.ctl.request_dump(sections)
+
+    def _runTunnelKillers(self, t):
+        for prefix, tunnel_killer in self._killing.items():
+            if tunnel_killer.timeout < t:
+                if tunnel_killer.state != 'unlocking':
+                    logging.info(
+                        'Abort destruction of tunnel %s %s (state: %s)',
+                        'to' if tunnel_killer.client else 'from',
+                        prefix.cn, tunnel_killer.state)
+                tunnel_killer.unlock()
+                del self._killing[prefix]
+            else:
+                tunnel_killer()
+
+    def babel_changed(self):
+        # Only with --babel-monitor. Other decisions are still taken
+        # periodically, with the view that is now always up-to-date.
+        if self._killing:
+            self._runTunnelKillers(time.time())
 
     def babel_dump(self):
         t = time.time()
         if self._killing:
-            for prefix, tunnel_killer in self._killing.items():
-                if tunnel_killer.timeout < t:
-                    if tunnel_killer.state != 'unlocking':
-                        logging.info(
-                            'Abort destruction of tunnel %s %s/%s (state: %s)',
-                            'to' if tunnel_killer.client else 'from',
-                            int(prefix, 2), len(prefix), tunnel_killer.state)
-                    tunnel_killer.unlock()
-                    del self._killing[prefix]
-                else:
-                    tunnel_killer()
-        remove = self._next_tunnel_refresh < t
-        if remove:
-            self._removeSomeTunnels()
-            self.resetTunnelRefresh()
-            self.cache.log()
-        self._makeNewTunnels(True)
+            self._runTunnelKillers(t)
+        if self.ctl.fresh & ctl.ROUTES:
+            remove = self._next_tunnel_refresh < t
+            if remove:
+                self._removeSomeTunnels()
+                self.resetTunnelRefresh()
+                self.cache.log()
+            self._makeNewTunnels(True)
         # XXX: Commented code is an attempt to clean up unused interfaces
         #      but babeld does not leave ipv6 membership for deleted taps,
         #      causing a memory leak in the kernel (capped by sysctl
         #      net.core.optmem_max), and after some time, new neighbours fail
         #      to see each other.
         #if remove and len(self._connecting) < len(self._free_iface_list):
-        #    self._tuntap(self._free_iface_list.pop())
-        self._next_refresh = time.time() + 5
+        #    tuntap(self._free_iface_list.pop(), False)
+        self._scheduleRefresh()
 
     def _cleanDeads(self):
         disconnected = False
@@ -705,17 +1069,14 @@ class TunnelManager(BaseTunnelManager):
                 del self._killing[prefix]
 
     def _kill(self, prefix):
-        logging.info('Killing the connection with %u/%u...',
-                     int(prefix, 2), len(prefix))
+        logging.info('Killing the connection with %s...', prefix.cn)
         self._abortTunnelKiller(prefix)
         connection = self._connection_dict.pop(prefix)
         self.freeInterface(connection.iface)
         connection.close()
         if self._gateway_manager is not None:
-            for ip in connection:
-                self._gateway_manager.remove(ip)
-        logging.trace('Connection with %u/%u killed',
-                      int(prefix, 2), len(prefix))
+            self._gateway_manager.remove(connection)
+        logging.trace('Connection with %s killed', prefix.cn)
 
     def _newTunnelScore(self, prefix):
         return (prefix in self._neighbour_set) + random.random()
@@ -729,14 +1090,12 @@ class TunnelManager(BaseTunnelManager):
         self.cache.connecting(prefix, 1)
         if not address:
             return False
-        logging.info('Establishing a connection with %u/%u',
-                     int(prefix, 2), len(prefix))
+        logging.info('Establishing a connection with %s', prefix.cn)
         with utils.exit:
             iface = self._getFreeInterface(prefix)
             self._connection_dict[prefix] = c = Connection(self, address, iface, prefix)
         if self._gateway_manager is not None:
-            for ip in c:
-                self._gateway_manager.add(ip, True)
+            self._gateway_manager.add(c, True)
         c.open()
         return True
 
@@ -843,20 +1202,35 @@ class TunnelManager(BaseTunnelManager):
         for prefix in self._connection_dict.keys():
             self._kill(prefix)
 
-    def handleClientEvent(self):
+    def handleClientEvent(self, c, ip):
+        prefix = c._prefix
+        logging.debug("connected to %s (external ip: %s)", prefix.cn, ip)
+        if self._connection_dict.get(prefix) is c:
+            # OpenVPN already rejected the server if its certificate is
+            # revoked (--crl-verify). We only know the serial if the peer
+            # also talked to us, which is enough to kill the tunnel later
+            # in _newVersion.
+            peer = self._peers.get(prefix)
+            c.connected(peer and peer.serial)
+        else:
+            logging.info("ignore connected notification for %s %r",
+                         prefix.cn, tuple(self._connection_dict))
+        if ip:
+            self._updateExternalIp(ip)
+
+    def handleRouteUp(self):
+        # BBB: Servers that don't push 'echo external_ip' only set it in
+        #      the environment of scripts, so it's sent by our route-up hook.
         msg = self._read_sock.recv(65536)
         logging.debug("route_up%s", msg)
-        common_name, time, serial, ip = eval(msg)
-        prefix = utils.binFromSubnet(common_name)
-        c = self._connection_dict.get(prefix)
-        if c and c.time < float(time):
-            try:
-                c.connected(serial)
-            except (KeyError, TypeError), e:
-                logging.error("%s (route_up %s)", e, common_name)
-        else:
-            logging.info("ignore route_up notification for %s %r",
-                         common_name, tuple(self._connection_dict))
+        common_name, ip = eval(msg)
+        c = self._connection_dict.get(utils.binFromSubnet(common_name))
+        if c and not c._external_ip:
+            c._external_ip = ip
+            if c._retry is None: # else, done by handleClientEvent
+                self._updateExternalIp(ip)
+
+    def _updateExternalIp(self, ip):
         if self._ip_changed:
             family, address = self._ip_changed(ip)
             if address:
@@ -871,8 +1245,8 @@ class TunnelManager(BaseTunnelManager):
         #      and not periodically like TunnelManager.
         for prefix in self.ctl.neighbours:
             if prefix:
-                peer = self._getPeer(prefix)
-                if peer.prefix != prefix:
+                peer = self._peers.get(prefix)
+                if peer is None:
                     self.sendto(prefix, None)
                 elif (peer.version < self._version and
                       self.sendto(prefix, '\0' + self._version)):
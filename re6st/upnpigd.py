@@ -29,11 +29,13 @@ class Forwarder(object):
         n = cls._lcg_n = (n * cls._lcg_a + cls._lcg_c) % 8192
         return 32768 + n
 
-    def __init__(self, description):
+    def __init__(self, description, loop):
         self._description = description
         self._u = miniupnpc.UPnP()
         self._u.discoverdelay = 200
         self._rules = []
+        self._loop = loop
+        loop.at(self.next_refresh, self._onTimeout)
 
     def __getattr__(self, name):
         wrapped = getattr(self._u, name)
@@ -44,8 +46,10 @@ class Forwarder(object):
                 raise UPnPException(str(e))
         return wraps(wrapped)(wrapper)
 
-    def select(self, r, w, t):
-        t.append((self.next_refresh, self.refresh))
+    def _onTimeout(self):
+        if self.next_refresh <= time.time():
+            self.refresh()
+        self._loop.at(self.next_refresh, self._onTimeout)
 
     def checkExternalIp(self, ip=None):
         if ip:
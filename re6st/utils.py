@@ -1,6 +1,7 @@
-import argparse, errno, hashlib, logging, os, select as _select
-import shlex, signal, socket, sqlite3, struct, subprocess
+import argparse, errno, fcntl, hashlib, heapq, itertools, logging, os
+import select as _select, shlex, signal, socket, sqlite3, struct, subprocess
 import sys, textwrap, threading, time, traceback
+from operator import itemgetter
 
 HMAC_LEN = len(hashlib.sha1('').digest())
 
@@ -173,22 +174,151 @@ class Popen(subprocess.Popen):
             return r
 
 
-def select(R, W, T):
-    try:
-        r, w, _ = _select.select(R, W, (),
-            max(0, min(T)[0] - time.time()) if T else None)
-    except _select.error as e:
-        if e.args[0] != errno.EINTR:
-            raise
-        return
-    for r in r:
-        R[r]()
-    for w in w:
-        W[w]()
-    t = time.time()
-    for next_refresh, refresh in T:
-        if next_refresh <= t:
-            refresh()
+class Timer(object):
+
+    __slots__ = 'when', 'callback'
+
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+
+    def cancel(self):
+        self.callback = None
+
+    @property
+    def pending(self):
+        return self.callback is not None
+
+
+class EventLoop(object):
+    """Timers are kept in a heap so that the cost of scheduling, cancelling
+    (lazily) or checking them does not depend on the number of timers.
+
+    Timers are one-shot. Callbacks must reschedule themselves if needed.
+
+    Interest in file descriptors is registered once, and is kept until it is
+    removed explicitly, which must be done before closing them. epoll(7) is
+    used (level-triggered) when available, otherwise select(2).
+    """
+
+    if hasattr(_select, 'epoll'):
+        # Errors are reported to callbacks when they read/write.
+        EPOLL_READ = _select.EPOLLIN | _select.EPOLLERR | _select.EPOLLHUP
+        EPOLL_WRITE = _select.EPOLLOUT | _select.EPOLLERR | _select.EPOLLHUP
+
+    def __init__(self):
+        self._timers = []
+        self._counter = itertools.count()
+        self._readers = {}
+        self._writers = {}
+        try:
+            self._epoll = _select.epoll()
+        except AttributeError:
+            self._epoll = None
+        else:
+            fd = self._epoll.fileno()
+            fcntl.fcntl(fd, fcntl.F_SETFD,
+                        fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+    def at(self, when, callback):
+        timer = Timer(when, callback)
+        heapq.heappush(self._timers, (when, next(self._counter), timer))
+        return timer
+
+    def _nextTimeout(self):
+        timers = self._timers
+        while timers:
+            when, _, timer = timers[0]
+            if timer.callback is not None:
+                return when
+            heapq.heappop(timers)
+
+    def _runTimers(self):
+        t = time.time()
+        timers = self._timers
+        while timers and timers[0][0] <= t:
+            timer = heapq.heappop(timers)[2]
+            callback = timer.callback
+            if callback is not None:
+                timer.callback = None
+                callback()
+
+    def _update(self, fd, callback_dict, callback):
+        if not isinstance(fd, (int, long)):
+            fd = fd.fileno()
+        if callback:
+            callback_dict[fd] = callback
+        elif callback_dict.pop(fd, None) is None:
+            return
+        epoll = self._epoll
+        if epoll:
+            mask = (fd in self._readers and _select.EPOLLIN) \
+                 | (fd in self._writers and _select.EPOLLOUT)
+            try:
+                if mask:
+                    epoll.modify(fd, mask)
+                else:
+                    epoll.unregister(fd)
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                if mask:
+                    epoll.register(fd, mask)
+
+    def addReader(self, fd, callback):
+        self._update(fd, self._readers, callback)
+
+    def removeReader(self, fd):
+        self._update(fd, self._readers, None)
+
+    def addWriter(self, fd, callback):
+        self._update(fd, self._writers, callback)
+
+    def removeWriter(self, fd):
+        self._update(fd, self._writers, None)
+
+    def _poll(self, timeout):
+        epoll = self._epoll
+        if epoll:
+            r = []
+            w = []
+            # Round up because the resolution of epoll is 1ms and Python
+            # truncates, which would wake us up a little too early.
+            for fd, event in epoll.poll(
+                    -1 if timeout is None else timeout + .001):
+                if event & self.EPOLL_READ:
+                    r.append(fd)
+                if event & self.EPOLL_WRITE:
+                    w.append(fd)
+            return r, w
+        return _select.select(self._readers, self._writers, (), timeout)[:2]
+
+    def runOnce(self):
+        timeout = self._nextTimeout()
+        if timeout is not None:
+            timeout = max(0, timeout - time.time())
+            if timeout == float('inf'):
+                timeout = None
+        try:
+            r, w = self._poll(timeout)
+        except (IOError, _select.error), e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        # A callback may remove interest in other file descriptors.
+        for r in r:
+            callback = self._readers.get(r)
+            if callback:
+                callback()
+        for w in w:
+            callback = self._writers.get(w)
+            if callback:
+                callback()
+        self._runTimers()
+
+    def run(self):
+        while True:
+            self.runOnce()
 
 def makedirs(*args):
     try:
@@ -197,22 +327,104 @@ def makedirs(*args):
         if e.errno != errno.EEXIST:
             raise
 
+class Prefix(tuple):
+    """Immutable bit string, as a (value, length) tuple of integers
+
+    This is how IPv6 addresses and prefixes are handled in re6st. The
+    operations that were done on strings of '0'/'1' (len, slicing,
+    concatenation, startswith, lexicographic order) are supported, and
+    str() returns such a string, which is the format used in databases and
+    over the network. Hashing and equality are those of tuples.
+    """
+    __slots__ = ()
+
+    value = property(itemgetter(0))
+    length = property(itemgetter(1))
+
+    @classmethod
+    def fromStr(cls, bits):
+        return cls((int(bits, 2) if bits else 0, len(bits)))
+
+    def __str__(self):
+        value, n = self
+        return bin(value)[2:].rjust(n, '0') if n else ''
+
+    def __repr__(self):
+        return 'Prefix(%r)' % str(self)
+
+    # Without a Python function, this is as fast as it was with strings.
+    cn = property('%u/%u'.__mod__,
+                  doc="Common name of certificates: value/length")
+
+    @property
+    def ip(self):
+        """IPv6 address with all bits after the prefix set to 0"""
+        return ipFromBin(self)
+
+    def __len__(self):
+        return self[1]
+
+    def _key(self):
+        value, n = self
+        return value << 128 - n, n
+
+    def __lt__(self, other):
+        return self._key() < other._key()
+
+    def __le__(self, other):
+        return self._key() <= other._key()
+
+    def __gt__(self, other):
+        return self._key() > other._key()
+
+    def __ge__(self, other):
+        return self._key() >= other._key()
+
+    def __add__(self, other):
+        a, n = self
+        b, m = other
+        return Prefix((a << m | b, n + m))
+
+    def __getslice__(self, i, j):
+        value, n = self
+        if j > n:
+            j = n
+        j -= i
+        if j <= 0:
+            return Prefix((0, 0))
+        return Prefix((value >> n - i - j & (1 << j) - 1, j))
+
+    def startswith(self, prefix):
+        value, n = prefix
+        n = self[1] - n
+        return n >= 0 and self[0] >> n == value
+
+    def __contains__(self, other):
+        """Whether the given prefix is inside this one"""
+        value, n = self
+        n = other[1] - n
+        return n >= 0 and other[0] >> n == value
+
+sqlite3.register_adapter(Prefix, str)
+
 def binFromIp(ip):
     return binFromRawIp(socket.inet_pton(socket.AF_INET6, ip))
 
-def binFromRawIp(ip):
-    ip1, ip2 = struct.unpack('>QQ', ip)
-    return bin(ip1)[2:].rjust(64, '0') + bin(ip2)[2:].rjust(64, '0')
+def binFromRawIp(ip, _unpack=struct.Struct('>QQ').unpack):
+    ip1, ip2 = _unpack(ip)
+    return Prefix((ip1 << 64 | ip2, 128))
 
 
-def ipFromBin(ip, suffix=''):
-    suffix_len = 128 - len(ip)
-    if suffix_len > 0:
-        ip += suffix.rjust(suffix_len, '0')
-    elif suffix_len:
+def ipFromBin(ip, suffix='', _pack=struct.Struct('>QQ').pack):
+    ip, n = ip
+    suffix_len = 128 - n
+    if suffix_len < 0:
         sys.exit("Prefix exceeds 128 bits")
+    ip <<= suffix_len
+    if suffix and suffix_len:
+        ip |= int(suffix, 2)
     return socket.inet_ntop(socket.AF_INET6,
-        struct.pack('>QQ', int(ip[:64], 2), int(ip[64:], 2)))
+        _pack(ip >> 64, ip & 0xffffffffffffffff))
 
 def dump_address(address):
     return ';'.join(map(','.join, address))
@@ -229,7 +441,7 @@ def parse_address(address_list):
 
 def binFromSubnet(subnet):
     p, l = subnet.split('/')
-    return bin(int(p))[2:].rjust(int(l), '0')
+    return Prefix((int(p), int(l)))
 
 def newHmacSecret():
     from random import getrandbits as g
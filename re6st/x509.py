@@ -1,16 +1,31 @@
 # -*- coding: utf-8 -*-
 import calendar, hashlib, hmac, logging, os, struct, subprocess, threading, time
+from collections import OrderedDict
 from datetime import datetime
 from OpenSSL import crypto
 from . import utils
 
+try:
+    from cryptography.hazmat.primitives.asymmetric.padding import PKCS1v15
+    crypto.PKey.to_cryptography_key
+except (ImportError, AttributeError): # BBB: pyOpenSSL < 16.1
+    PKCS1v15 = None
+else:
+    # Same padding as 'openssl rsautl', so that nodes using any
+    # implementation can exchange session keys.
+    PKCS1v15 = PKCS1v15()
+
 def newHmacSecret():
     x = datetime.utcnow()
     return utils.newHmacSecret(int(time.mktime(x.timetuple())) * 1000000
                                 + x.microsecond)
 
 def networkFromCa(ca):
-    return bin(ca.get_serial_number())[3:]
+    # The most significant bit of the serial is only there to encode
+    # the length of the network.
+    serial = ca.get_serial_number()
+    n = serial.bit_length() - 1
+    return utils.Prefix((serial - (1 << n), n))
 
 def subnetFromCert(cert):
     return cert.get_subject().CN
@@ -24,7 +39,7 @@ def openssl(*args):
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE)
 
-def encrypt(cert, data):
+def openssl_encrypt(cert, data):
     r, w = os.pipe()
     try:
         threading.Thread(target=os.write, args=(w, cert)).start()
@@ -38,6 +53,13 @@ def encrypt(cert, data):
         raise subprocess.CalledProcessError(p.returncode, 'openssl', err)
     return out
 
+if PKCS1v15:
+    def encrypt(cert, data):
+        return crypto.load_certificate(crypto.FILETYPE_PEM, cert).get_pubkey() \
+            .to_cryptography_key().encrypt(data, PKCS1v15)
+else:
+    encrypt = openssl_encrypt
+
 def fingerprint(cert, alg='sha1'):
     return hashlib.new(alg, crypto.dump_certificate(crypto.FILETYPE_ASN1, cert))
 
@@ -85,10 +107,13 @@ class NewSessionError(Exception):
 
 class Cert(object):
 
+    verify_cache_size = 1024
+
     def __init__(self, ca, key, cert=None):
         self.ca_path = ca
         self.cert_path = cert
         self.key_path = key
+        self._verified = OrderedDict()
         with open(ca) as f:
             self.ca = crypto.load_certificate(crypto.FILETYPE_PEM, f.read())
         with open(key) as f:
@@ -115,8 +140,11 @@ class Cert(object):
         self.cert, next_renew = maybe_renew(self.cert_path, self.cert,
               "Certificate", lambda: registry.renewCertificate(self.prefix),
               self.cert.get_serial_number() in crl)
-        self.ca, ca_renew = maybe_renew(self.ca_path, self.ca,
+        ca = self.ca
+        self.ca, ca_renew = maybe_renew(self.ca_path, ca,
               "CA Certificate", registry.getCa)
+        if self.ca is not ca:
+            self._verified.clear()
         return min(next_renew, ca_renew)
 
     def loadVerify(self, cert, strict=False, type=crypto.FILETYPE_PEM):
@@ -136,19 +164,59 @@ class Cert(object):
                     raise VerifyError(int(code), int(depth), msg)
         return r
 
+    def loadVerifyPeer(self, cert):
+        """Strictly verify a DER certificate received from a peer
+
+        Return (cert, serial, notAfter, prefix). Successful verifications
+        are kept in a LRU cache until the certificate expires, so that a peer
+        sending the same certificate again costs only a hash.
+        """
+        key = hashlib.sha1(cert).digest()
+        verified = self._verified
+        try:
+            r = verified.pop(key)
+        except KeyError:
+            pass
+        else:
+            if time.time() < r[2]:
+                verified[key] = r
+                return r
+        cert = self.loadVerify(cert, True, crypto.FILETYPE_ASN1)
+        verified[key] = r = (cert, cert.get_serial_number(), notAfter(cert),
+                             utils.binFromSubnet(subnetFromCert(cert)))
+        if len(verified) > self.verify_cache_size:
+            verified.popitem(False)
+        return r
+
+    def purgeVerified(self, crl):
+        verified = self._verified
+        for key in [key for key, r in verified.iteritems() if r[1] in crl]:
+            del verified[key]
+
     def verify(self, sign, data):
         crypto.verify(self.ca, sign, data, 'sha512')
 
     def sign(self, data):
         return crypto.sign(self.key, data, 'sha512')
 
-    def decrypt(self, data):
+    def openssl_decrypt(self, data):
         p = openssl('rsautl', '-decrypt', '-inkey', self.key_path)
         out, err = p.communicate(data)
         if p.returncode:
             raise subprocess.CalledProcessError(p.returncode, 'openssl', err)
         return out
 
+    if PKCS1v15:
+        def decrypt(self, data):
+            try:
+                key = self._decrypt_key
+            except AttributeError:
+                # Loading a private key checks it, which is slow.
+                key = self._decrypt_key = self.key.to_cryptography_key()
+            return key.decrypt(data, PKCS1v15)
+    else:
+        decrypt = openssl_decrypt
+
     def verifyVersion(self, version):
         try:
             n = 1 + (ord(version[0]) >> 5)
@@ -197,15 +265,6 @@ class Peer(object):
     def connected(self):
         return self._last is None or time.time() < self._last + 60
 
-    def __ne__(self, other):
-        raise AssertionError
-    __eq__ = __ge__ = __le__ = __ne__
-
-    def __gt__(self, other):
-        return self.prefix > (other if type(other) is str else other.prefix)
-    def __lt__(self, other):
-        return self.prefix < (other if type(other) is str else other.prefix)
-
     def hello0(self, cert):
         if self._hello < time.time():
             try:
@@ -84,7 +84,6 @@ setup(
     },
     package_data = {
         're6st': [
-            'ovpn-server',
             'ovpn-client',
         ],
     },